@@ -0,0 +1,634 @@
+#!/usr/bin/env python
+
+# benchmark the gold masking pipeline:
+#   - findGoldMask with different random walker solvers and binning: time, peak memory and agreement with the
+#     full resolution bf masks, on particles from image files or on synthetic stacks
+#   - the full maskGold.main() path with different parallel/pipeline options on synthetic stacks
+#   - on synthetic stacks, the recovered masks of each solver/binning configuration and of each maskGold.main() run
+#     against the true masks of the injected gold: IoU, boundary error, missed and false gold. a configuration
+#     whose mean IoU is more than --truth_drop below the reference (bf at full resolution, the first --main_options)
+#     fails, so that a speed option is only enabled if it does not hurt the segmentation
+#   - maskGold.py --micrograph on a synthetic micrograph: the masks cut out of the micrograph mask against the masks
+#     of the same boxes segmented one by one and against the true masks
+#   - the --maskweight numpy mask weights of maskGold.py against mask.distance of EMAN2 (--maskweights)
+#   - the --normalize numpy normalization of simGold.py against normalize.mask.circlemean of EMAN2 (--circlemean)
+#   - the unrotated goldAPI.ShapeTemplate copies of simGold.py against the shape arrays of the centered markers (--shapes)
+#   - the import time of the numpy API (goldAPI.py) and of the scripts, in fresh interpreters
+# the synthetic stacks are noise backgrounds with the gold shapes of simGold.py. if EMAN2 is not installed,
+# a small numpy stand-in (enough for the shape generators and the mrcs path of maskGold.py) is used
+
+import os, sys, argparse, time, resource, multiprocessing, tempfile, shutil, json, platform, subprocess, itertools, Queue
+
+import numpy
+
+try:
+	import EMAN2
+	localEMAN2 = False
+except ImportError:
+	localEMAN2 = True
+
+from scipy import ndimage
+from skimage import exposure
+
+def main():
+	args= parse_command_line()
+
+	report = {"date":time.strftime("%Y-%m-%d %H:%M:%S"), "host":platform.node(), "python":platform.python_version(),
+		"numpy":numpy.__version__, "localEMAN2":localEMAN2, "argv":sys.argv[1:], "segmentation":[], "main":[], "imports":[], "micrograph":[], "maskweights":[], "circlemean":[], "shapes":[]}
+
+	nFail = 0
+	if args.imports:
+		nFail += benchImports(args, report)
+	if args.maskweights:
+		nFail += benchMaskWeights(args, report)
+	if args.circlemean:
+		nFail += benchCircleMean(args, report)
+	if args.shapes:
+		nFail += benchShapes(args, report)
+	if args.micrograph:
+		nFail += benchMicrograph(args, report)
+	if args.synthetic:
+		nFail += benchSynthetic(args, report)
+	elif args.imageFiles:
+		particles = readParticles(args)
+		if not particles:
+			print "ERROR: no particles to benchmark"
+			sys.exit(-1)
+		nFail += benchSegmentation(particles, args, report, {})
+
+	if args.json:
+		with open(args.json, "w") as fp:
+			json.dump(report, fp, indent=1, sort_keys=True, default=float)
+	if nFail:
+		print "%d check(s) failed: IoU below %g, --micrograph masks unlike the boxed ones, --maskweights above %g, --circlemean above %g, --shapes copies unlike the shape arrays, a failed maskGold.py run, IoU against the true masks more than %g below the reference or goldAPI.py import (see --imports)" % (nFail, args.iou_tol, args.maskweight_tol, args.circlemean_tol, args.truth_drop)
+		sys.exit(1)
+
+# libraries that importing goldAPI.py must not pull in: they are imported on first use
+heavyLibraries = ["EMAN2", "scipy", "skimage"]
+
+def benchMaskWeights(args, report):
+	# largest difference between the --maskweight numpy and eman2 weights of the true masks of a synthetic stack of
+	# each --gold shape other than none (first of --boxsizes) for a few --maskpad/--masksoft values. masks without
+	# gold would not test the distance transforms, so a stack without gold fails. --maskweight numpy should only
+	# become the default of maskGold.py once this passes with a real EMAN2
+	if localEMAN2:
+		print "ERROR: --maskweights requires EMAN2"
+		return 1
+	shapes = goldShapesWithGold(args)
+	if not shapes:
+		print "ERROR: --maskweights requires a --gold shape other than none"
+		return 1
+	boxsize = args.boxsizes[0]
+	nFail = 0
+	for gold in shapes:
+		stackFile = tempfile.mktemp(prefix="benchGold.", suffix=".mrcs", dir=args.workdir)
+		try:
+			masks = writeSyntheticStack(stackFile, boxsize, gold, args)
+		finally:
+			if os.path.exists(stackFile): os.remove(stackFile)
+		nGold = int(numpy.count_nonzero(masks.reshape(len(masks), -1).any(axis=1)))
+		print "mask weights: %d masks (%d with gold), box size %d gold=%s, numpy against eman2" % (len(masks), nGold, boxsize, gold)
+		if not nGold:
+			print "ERROR: the synthetic stack has no gold (--gold_fraction %g) FAIL" % (args.gold_fraction)
+			report["maskweights"].append({"boxsize":boxsize, "gold":gold, "fail":True})
+			nFail += 1
+			continue
+		print "%8s %8s %12s %12s" % ("maskpad", "masksoft", "maxdiff", "meandiff")
+		for maskpad, masksoft in [(0, 0), (2, 0), (0, 3), (2, 3), (1.5, 6)]:
+			weights = {}
+			for engine in ["numpy", "eman2"]:
+				weights[engine] = maskGold.maskWeights(masks, argparse.Namespace(maskpad=maskpad, masksoft=masksoft, maskweight=engine))
+			diff = numpy.abs(weights["numpy"]-weights["eman2"])
+			status = ""
+			if diff.max()>args.maskweight_tol:
+				status = "FAIL"
+				nFail += 1
+			print "%8g %8g %12.3g %12.3g %s" % (maskpad, masksoft, diff.max(), diff.mean(), status)
+			report["maskweights"].append({"boxsize":boxsize, "gold":gold, "maskpad":maskpad, "masksoft":masksoft, "max_diff":float(diff.max()),
+				"mean_diff":float(diff.mean()), "fail":bool(status)})
+	return nFail
+
+def benchCircleMean(args, report):
+	# largest difference between simGold.py --normalize numpy (goldAPI.normalizeCircleMean) and the EMAN2
+	# normalize.mask.circlemean processor on a synthetic stack of each --gold shape other than none (first of
+	# --boxsizes) for a few particle radii. --normalize numpy should only become the default of simGold.py once this
+	# passes with a real EMAN2
+	if localEMAN2:
+		print "ERROR: --circlemean requires EMAN2"
+		return 1
+	shapes = goldShapesWithGold(args)
+	if not shapes:
+		print "ERROR: --circlemean requires a --gold shape other than none"
+		return 1
+	boxsize = args.boxsizes[0]
+	nFail = 0
+	for gold in shapes:
+		stackFile = tempfile.mktemp(prefix="benchGold.", suffix=".mrcs", dir=args.workdir)
+		try:
+			writeSyntheticStack(stackFile, boxsize, gold, args)
+			particles = numpy.array(stackIO.openStack(stackFile).read(0, args.nptcl), dtype=numpy.float32)
+		finally:
+			if os.path.exists(stackFile): os.remove(stackFile)
+		print "circlemean: %d particles, box size %d gold=%s, numpy against eman2" % (len(particles), boxsize, gold)
+		print "%8s %12s %12s" % ("radius", "maxdiff", "meandiff")
+		for radius in [boxsize//4, boxsize*3//8, boxsize//2-1]:
+			normalized = goldAPI.normalizeCircleMean(particles.copy(), radius)
+			diff = numpy.zeros(len(particles))
+			for i in range(len(particles)):
+				img = EMAN2.EMNumPy.numpy2em(particles[i].copy())
+				img.process_inplace("normalize.mask.circlemean", {"norm":1, "mask":0, "radius":radius, "masksoft":3})
+				diff[i] = numpy.abs(normalized[i]-EMAN2.EMNumPy.em2numpy(img)).max()
+			status = ""
+			if diff.max()>args.circlemean_tol:
+				status = "FAIL"
+				nFail += 1
+			print "%8g %12.3g %12.3g %s" % (radius, diff.max(), diff.mean(), status)
+			report["circlemean"].append({"boxsize":boxsize, "gold":gold, "radius":radius, "max_diff":float(diff.max()),
+				"mean_diff":float(diff.mean()), "fail":bool(status)})
+	return nFail
+
+def benchImports(args, report):
+	# best import time of each module over --import_repeat fresh interpreters, and the heavy libraries it imports
+	print "imports: best of %d fresh interpreters" % (args.import_repeat)
+	print "%-10s %10s  %s" % ("module", "time(ms)", "heavy libraries")
+	nFail = 0
+	for module in ["numpy", "goldAPI", "maskGold", "simGold"]:
+		try:
+			times, heavy = zip(*[importTime(module) for i in range(args.import_repeat)])
+		except subprocess.CalledProcessError:
+			print "%-10s %10s" % (module, "failed")
+			continue
+		ms = 1000*min(times)
+		status = ""
+		if module == "goldAPI" and (heavy[0] or (args.import_max and ms>args.import_max)):
+			status = "FAIL"
+			nFail += 1
+		print "%-10s %10.1f  %s %s" % (module, ms, ",".join(heavy[0]) or "-", status)
+		report["imports"].append({"module":module, "ms":ms, "heavy":heavy[0], "fail":bool(status)})
+	return nFail
+
+def importTime(module):
+	code = "import sys, time, json\nt0 = time.time()\nimport %s\nt = time.time()-t0\n" % (module)
+	code += "print json.dumps([t, sorted(set(m.split('.')[0] for m in sys.modules if sys.modules[m]) & set(%r))])" % (heavyLibraries)
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__))] + filter(None, [env.get("PYTHONPATH")]))
+	with open(os.devnull, "w") as devnull:
+		output = subprocess.check_output([sys.executable, "-c", code], env=env, stderr=devnull)
+	return tuple(json.loads(output.splitlines()[-1]))
+
+def benchSegmentation(particles, args, report, tags, truth=None):
+	boxsize = particles[0].shape[-1]
+
+	# the default bf solver at full resolution is the reference for all other configurations
+	configs = [("bf", 1)] + [(solver, binning) for binning in args.bins for solver in args.solvers if (solver, binning)!=("bf", 1)]
+
+	results = {}
+	for config in configs:
+		# a fresh process for each configuration so that the peak memory is not inherited from the previous one
+		pool = multiprocessing.Pool(1)
+		results[config] = pool.apply(benchSolver, (particles, config, args))
+		pool.close()
+		pool.join()
+		if args.verbose>1:
+			print "%s bin %d: %.3f s/particle" % (config[0], config[1], numpy.mean(results[config][0]))
+
+	refMasks = results[("bf", 1)][1]
+	refTime = numpy.mean(results[("bf", 1)][0])
+	refTruth = truthMetrics(refMasks, truth) if truth is not None else None
+	print "findGoldMask: %d particles, box size %d %s" % (len(particles), boxsize, " ".join("%s=%s" % (k, v) for k, v in sorted(tags.items())))
+	print "%-8s %-8s %4s %10s %10s %8s %8s %8s %12s%s" % ("solver", "mode", "bin", "s/ptcl", "ptcl/s", "speedup", "meanIoU", "minIoU", "peakRSS(MB)", truthHeader if truth is not None else "")
+	nFail = 0
+	for config in configs:
+		times, masks, mode, maxrss = results[config]
+		iou = [maskGold.maskIoU(m, r) for m, r in zip(masks, refMasks)]
+		t = numpy.mean(times)
+		status = ""
+		if numpy.min(iou)<args.iou_tol:
+			status = "FAIL"
+		row = dict(tags)
+		row.update({"boxsize":boxsize, "particles":len(particles), "solver":config[0], "mode":mode, "bin":config[1], "s_per_particle":t,
+			"particles_per_s":1.0/t, "speedup":refTime/t, "iou_mean":numpy.mean(iou), "iou_min":numpy.min(iou), "peak_rss_mb":maxrss/1024.})
+		columns = ""
+		if truth is not None:
+			metrics = truthMetrics(masks, truth)
+			if refTruth["truth_iou_mean"]-metrics["truth_iou_mean"]>args.truth_drop:
+				status = "FAIL"
+			row.update(metrics)
+			columns = truthColumns(metrics)
+		nFail += bool(status)
+		row["fail"] = bool(status)
+		print "%-8s %-8s %4d %10.4f %10.2f %8.2f %8.4f %8.4f %12.1f%s %s" % (config[0], mode, config[1], t, 1.0/t, refTime/t, numpy.mean(iou), numpy.min(iou), maxrss/1024., columns, status)
+		report["segmentation"].append(row)
+	return nFail
+
+# the columns of the metrics against the true masks of the synthetic stacks
+truthHeader = " %9s %9s %8s %6s %6s" % ("truthIoU", "minTruth", "bnd(px)", "missed", "false")
+
+def truthColumns(metrics):
+	return " %9.4f %9.4f %8.3f %6d %6d" % (metrics["truth_iou_mean"], metrics["truth_iou_min"], metrics["boundary_error"], metrics["missed"], metrics["false"])
+
+def truthMetrics(masks, truth):
+	# agreement of the recovered masks with the true masks: mean and minimal IoU, mean boundary error of the particles
+	# where both have gold, number of particles with missed gold (e.g. skipped) and with gold found where there is none
+	iou = [maskGold.maskIoU(m, t) for m, t in zip(masks, truth)]
+	boundary = [boundaryError(m, t) for m, t in zip(masks, truth)]
+	boundary = [b for b in boundary if b is not None]
+	found = numpy.array([numpy.any(m) for m in masks])
+	gold = numpy.array([numpy.any(t) for t in truth])
+	return {"truth_iou_mean":numpy.mean(iou), "truth_iou_min":numpy.min(iou), "boundary_error":numpy.mean(boundary) if boundary else numpy.nan,
+		"missed":int(numpy.count_nonzero(gold & ~found)), "false":int(numpy.count_nonzero(found & ~gold))}
+
+def boundaryError(mask, truth):
+	# mean distance in pixels of the boundary pixels of each mask to the boundary of the other one. None if one of
+	# the masks is empty
+	mask = numpy.asarray(mask)>0
+	truth = numpy.asarray(truth)>0
+	if not mask.any() or not truth.any(): return None
+	edge = mask & ~ndimage.binary_erosion(mask)
+	trueEdge = truth & ~ndimage.binary_erosion(truth)
+	distances = numpy.concatenate((ndimage.distance_transform_edt(~trueEdge)[edge], ndimage.distance_transform_edt(~edge)[trueEdge]))
+	return float(distances.mean())
+
+def readParticles(args):
+	particles = []
+	for imageFile in args.imageFiles:
+		nImage = EMAN2.EMUtil.get_image_count(imageFile)
+		for i in range(min(nImage, args.nptcl-len(particles))):
+			d = EMAN2.EMData(imageFile, i)
+			data = numpy.array(EMAN2.EMNumPy.em2numpy(d), dtype=numpy.float32)
+			particles.append(exposure.rescale_intensity(data, out_range=(-1, 1)))
+		if len(particles)>=args.nptcl: break
+	return particles
+
+def benchSolver(particles, config, args):
+	solver, binning = config
+	options = argparse.Namespace(solver=solver, solver_tol=args.solver_tol, solver_autosize=args.solver_autosize, bin=binning, band=args.band)
+	mode = maskGold.chooseSolver(particles[0].shape, options)
+	times = []
+	masks = []
+	for data in particles:
+		t0 = time.time()
+		masks.append(maskGold.findGoldMask(data, options).astype(numpy.uint8))
+		times.append(time.time()-t0)
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss	# KB on Linux
+	return times, masks, mode, maxrss
+
+def benchSynthetic(args, report):
+	workdir = tempfile.mkdtemp(prefix="benchGold.", dir=args.workdir)
+	nFail = 0
+	try:
+		for boxsize in args.boxsizes:
+			for gold in args.gold:
+				stackFile = os.path.join(workdir, "synthetic_%d_%s.mrcs" % (boxsize, gold))
+				truth = writeSyntheticStack(stackFile, boxsize, gold, args)
+				particles = [exposure.rescale_intensity(d, out_range=(-1, 1)) for d in stackIO.openStack(stackFile).read(0, args.nptcl)]
+				nFail += benchSegmentation(particles, args, report, {"gold":gold}, truth)
+
+				print "maskGold.main: %d particles, box size %d gold=%s" % (args.nptcl, boxsize, gold)
+				print "%-40s %10s %10s %12s%s" % ("options", "wall(s)", "ptcl/s", "peakRSS(MB)", truthHeader)
+				refTruth = None
+				for mainOptions in args.main_options:
+					result = benchMain(stackFile, mainOptions, args)
+					if result is None:
+						print "%-40s %10s FAIL" % (mainOptions, "failed")
+						report["main"].append({"boxsize":boxsize, "gold":gold, "particles":args.nptcl, "options":mainOptions, "fail":True})
+						nFail += 1
+						continue
+					wall, maxrss = result
+					metrics = truthMetrics(stackIO.MaskStack(maskGold.goldMaskFile(stackFile)).read(0, args.nptcl)[0], truth)
+					if refTruth is None: refTruth = metrics
+					status = ""
+					if refTruth["truth_iou_mean"]-metrics["truth_iou_mean"]>args.truth_drop:
+						status = "FAIL"
+						nFail += 1
+					print "%-40s %10.2f %10.2f %12.1f%s %s" % (mainOptions, wall, args.nptcl/wall, maxrss/1024., truthColumns(metrics), status)
+					row = {"boxsize":boxsize, "gold":gold, "particles":args.nptcl, "options":mainOptions,
+						"wall":wall, "particles_per_s":args.nptcl/wall, "peak_rss_mb":maxrss/1024., "fail":bool(status)}
+					row.update(metrics)
+					report["main"].append(row)
+	finally:
+		if not args.keep: shutil.rmtree(workdir)
+	return nFail
+
+def writeSyntheticStack(stackFile, boxsize, gold, args):
+	# low-pass filtered gaussian noise with a gold marker of the given shape (none, circle, ellipse, ...) on
+	# --gold_fraction of the particles, at a random shift from the center. returns the true (n, ny, nx) uint8 masks
+	rng = numpy.random.RandomState(args.seed)
+	marker = goldMarker(boxsize, gold)
+	stack = stackIO.createStack(stackFile, (boxsize, boxsize))
+	truth = numpy.zeros((args.nptcl, boxsize, boxsize), dtype=numpy.uint8)
+	maxShift = boxsize//8
+	for i in range(args.nptcl):
+		data = ndimage.gaussian_filter(rng.normal(0, 1, (boxsize, boxsize)), 1.5)
+		data /= data.std()
+		if marker is not None and rng.uniform()<args.gold_fraction:
+			dy, dx = rng.randint(-maxShift, maxShift+1, size=2)
+			shifted = numpy.roll(numpy.roll(marker, dy, axis=0), dx, axis=1)
+			data += args.marker_pixel*shifted
+			truth[i] = shifted>0
+		stack.write(i, data[numpy.newaxis].astype(numpy.float32))
+	stack.close()
+	return truth
+
+goldShapes = ["none", "circle", "ellipse", "triangle", "rectangle", "square", "diamond", "octagon", "star"]
+
+def goldMarker(boxsize, gold):
+	# the marker made by the simGold.py shape generator, with sizes scaled to the box size
+	if gold == "none": return None
+	maskImg = EMAN2.EMData(boxsize, boxsize)
+	maskImg.to_zero()
+	shapeMasks = {"circle":simGold.circleMask, "ellipse":simGold.ellipseMask, "triangle":simGold.triangleMask,
+		"rectangle":simGold.rectMask, "square":simGold.squareMask, "diamond":simGold.diamondMask,
+		"octagon":simGold.octMask, "star":simGold.starMask}
+	img = shapeMasks[gold](maskImg, *markerSizes(boxsize, gold))
+	return numpy.array(EMAN2.EMNumPy.em2numpy(img), dtype=numpy.float32)
+
+def markerSizes(boxsize, gold):
+	# the size options of the marker of goldMarker(), in the order of goldAPI.shapeOptions
+	s = max(boxsize//16, 2)
+	return {"circle":[s], "ellipse":[s, s*3//2], "triangle":[s*3], "rectangle":[s*2, s], "square":[s*2],
+		"diamond":[s], "octagon":[s, s//2], "star":[s]}[gold]
+
+def benchShapes(args, report):
+	# unrotated and unscaled goldAPI.ShapeTemplate copies, as drawn by simGold.py with --rotate, --markers or
+	# --size_jitter, against the goldAPI.shapeArray() arrays of the single centered markers: any differing pixel
+	# fails. for each of --boxsizes, each of these plus one (odd boxes for even --boxsizes) and each shape, the
+	# goldMarker() sizes and these sizes plus one in every combination, so that both odd and even sizes are checked
+	# along each axis
+	print "shapes: ShapeTemplate.rasterize() at rotation 0 and scale 1 against shapeArray()"
+	print "%8s %-10s %-12s %8s %8s" % ("boxsize", "shape", "sizes", "pixels", "differ")
+	nFail = 0
+	for boxsize in sorted(set(args.boxsizes+[b+1 for b in args.boxsizes])):
+		for gold in goldShapes[1:]:
+			base = markerSizes(boxsize, gold)
+			for offsets in itertools.product([0, 1], repeat=len(base)):
+				sizes = [size+offset for size, offset in zip(base, offsets)]
+				array = goldAPI.shapeArray(boxsize, gold, sizes).astype(bool)
+				copy = goldAPI.ShapeTemplate(gold, sizes).rasterize(boxsize, numpy.zeros(1), numpy.ones(1))[0]
+				differ = numpy.count_nonzero(array!=copy)
+				status = ""
+				if differ:
+					status = "FAIL"
+					nFail += 1
+				print "%8d %-10s %-12s %8d %8d %s" % (boxsize, gold, ",".join(map(str, sizes)), array.sum(), differ, status)
+				report["shapes"].append({"boxsize":boxsize, "gold":gold, "sizes":sizes, "pixels":int(array.sum()),
+					"differ":differ, "fail":bool(status)})
+	return nFail
+
+def benchMicrograph(args, report):
+	# for each --gold shape with gold, a --micrograph_size micrograph of low-pass filtered noise with boxes of the
+	# first --boxsizes size on a grid overlapping by a quarter box and a gold marker near the center of
+	# --gold_fraction of the boxes. maskGold.py --micrograph and maskGold.py on the stack of the cut out boxes must
+	# find the same masks. a micrograph without gold would pass trivially, so it fails
+	shapes = goldShapesWithGold(args)
+	if not shapes:
+		print "ERROR: --micrograph requires a --gold shape other than none"
+		return 1
+	workdir = tempfile.mkdtemp(prefix="benchGold.", dir=args.workdir)
+	nFail = 0
+	try:
+		boxsize = args.boxsizes[0]
+		for gold in shapes:
+			micrographFile = os.path.join(workdir, "micrograph_%s.mrc" % (gold))
+			stackFile = os.path.join(workdir, "boxes_%s.mrcs" % (gold))
+			boxes, truth = writeSyntheticMicrograph(micrographFile, boxsize, gold, args)
+			micrograph = stackIO.openStack(micrographFile).read(0, 1)[0]
+			stack = stackIO.createStack(stackFile, (boxsize, boxsize))
+			stack.write(0, numpy.array([maskGold.cutBox(micrograph, x0, y0, w, h)[0] for x0, y0, w, h in boxes]))
+			stack.close()
+			cutTruth = numpy.array([maskGold.cutBox(truth, x0, y0, w, h)[0] for x0, y0, w, h in boxes])
+
+			print "maskGold.py --micrograph: %d x %d micrograph, %d boxes of %d, gold=%s" % (args.micrograph_size, args.micrograph_size, len(boxes), boxsize, gold)
+			if not truth.any():
+				print "ERROR: the synthetic micrograph has no gold (--gold_fraction %g) FAIL" % (args.gold_fraction)
+				report["micrograph"].append({"boxsize":boxsize, "gold":gold, "particles":len(boxes), "fail":True})
+				nFail += 1
+				continue
+			print "%-40s %10s %10s %8s %8s %8s%s" % ("options", "wall(s)", "ptcl/s", "goldpix", "meanIoU", "minIoU", truthHeader)
+			for mode, inputFile in [("particles", stackFile), ("micrograph", micrographFile)]:
+				options = args.micrograph_options + (" --micrograph" if mode=="micrograph" else "")
+				result = benchMain(inputFile, options, args)
+				if result is None:
+					# without the masks of the boxes there is nothing to compare the micrograph masks with
+					print "%-40s %10s FAIL" % (options.strip(), "failed")
+					report["micrograph"].append({"mode":mode, "options":options, "boxsize":boxsize, "gold":gold, "fail":True})
+					nFail += 1
+					break
+				wall, maxrss = result
+				masks = stackIO.MaskStack(maskGold.goldMaskFile(inputFile)).read(0, len(boxes))[0]
+				if mode == "particles": particleMasks = masks
+				iou = [maskGold.maskIoU(m, r) for m, r in zip(masks, particleMasks)]
+				metrics = truthMetrics(masks, cutTruth)
+				status = ""
+				if numpy.mean(iou)<args.micrograph_iou:
+					status = "FAIL"
+					nFail += 1
+				print "%-40s %10.2f %10.2f %8.1f %8.4f %8.4f%s %s" % (options.strip(), wall, len(boxes)/wall, masks.sum(axis=(1, 2)).mean(), numpy.mean(iou), numpy.min(iou), truthColumns(metrics), status)
+				row = {"mode":mode, "options":options, "boxsize":boxsize, "gold":gold, "particles":len(boxes), "wall":wall, "particles_per_s":len(boxes)/wall,
+					"gold_pixels":float(masks.sum(axis=(1, 2)).mean()), "iou_mean":numpy.mean(iou), "iou_min":numpy.min(iou), "fail":bool(status)}
+				row.update(metrics)
+				report["micrograph"].append(row)
+	finally:
+		if not args.keep: shutil.rmtree(workdir)
+	return nFail
+
+def goldShapesWithGold(args):
+	# the --gold shapes of the checks that are meaningless without gold (--micrograph, --maskweights, --circlemean)
+	return [gold for gold in args.gold if gold != "none"]
+
+def writeSyntheticMicrograph(micrographFile, boxsize, gold, args):
+	# writes the micrograph and its .box file, returns the boxes and the true gold mask of the micrograph
+	rng = numpy.random.RandomState(args.seed)
+	size = args.micrograph_size
+	data = ndimage.gaussian_filter(rng.normal(0, 1, (size, size)), 1.5)
+	data /= data.std()
+	truth = numpy.zeros((size, size), dtype=numpy.uint8)
+	marker = goldMarker(boxsize, gold)
+	step = boxsize*3//4
+	boxes = [[x0, y0, boxsize, boxsize] for y0 in range(0, size-boxsize+1, step) for x0 in range(0, size-boxsize+1, step)]
+	maxShift = boxsize//8
+	for x0, y0, w, h in boxes:
+		if marker is not None and rng.uniform()<args.gold_fraction:
+			dy, dx = rng.randint(-maxShift, maxShift+1, size=2)
+			shifted = numpy.roll(numpy.roll(marker, dy, axis=0), dx, axis=1)
+			data[y0:y0+h, x0:x0+w] += args.marker_pixel*shifted*(truth[y0:y0+h, x0:x0+w]==0)
+			truth[y0:y0+h, x0:x0+w] |= shifted>0
+	micrograph = stackIO.createStack(micrographFile, (size, size))
+	micrograph.write(0, data[numpy.newaxis].astype(numpy.float32))
+	micrograph.close()
+	with open(os.path.splitext(micrographFile)[0]+".box", "w") as fp:
+		for box in boxes:
+			fp.write("%d\t%d\t%d\t%d\n" % tuple(box))
+	return boxes, truth
+
+def benchMain(stackFile, mainOptions, args):
+	# run maskGold.main() in a child process (which may start its own worker pool) and report the wall time and
+	# the peak memory of the child and its workers. the gold masks are saved in the .goldmask file of the stack.
+	# None if the child exits without a result (an exception or a command line error)
+	queue = multiprocessing.Queue()
+	argv = [stackFile, "--verbose", "0", "--outformat", "mrcs", "--savemask"] + mainOptions.split()
+	process = multiprocessing.Process(target=runMain, args=(argv, queue))
+	process.start()
+	result = None
+	while result is None:
+		try:
+			result = queue.get(timeout=1)
+		except Queue.Empty:
+			if process.is_alive(): continue
+			# the result of a child that just finished may still be in the pipe
+			try:
+				result = queue.get(timeout=1)
+			except Queue.Empty:
+				break
+	process.join()
+	if result is None:
+		print "ERROR: maskGold.py %s exited with status %s without a result" % (" ".join(argv), process.exitcode)
+	return result
+
+def runMain(argv, queue):
+	t0 = time.time()
+	maskGold.main(argv)
+	wall = time.time()-t0
+	maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	queue.put((wall, maxrss))
+
+class LocalEMData(object):
+	# numpy backed stand-in for the few EMData methods used by the shape generators and maskGold.py
+	def __init__(self, nx=1, ny=None):
+		self.array = numpy.zeros((ny or nx, nx), dtype=numpy.float32)
+
+	def get_xsize(self): return self.array.shape[1]
+	def get_ysize(self): return self.array.shape[0]
+	def to_zero(self): self.array[...] = 0
+	def to_one(self): self.array[...] = 1
+	def mult(self, v): self.array *= v
+
+	def __rsub__(self, v):
+		return LocalEMNumPy.numpy2em(v-self.array)
+
+	def process_inplace(self, processor, params={}):
+		if processor == "mask.sharp":
+			ny, nx = self.array.shape
+			y, x = numpy.indices(self.array.shape)
+			self.array[numpy.hypot(x-nx//2, y-ny//2) > params["outer_radius"]] = 0
+		else:
+			raise NotImplementedError("processor %s requires EMAN2" % (processor))
+
+class LocalEMNumPy(object):
+	@staticmethod
+	def em2numpy(d): return d.array
+	@staticmethod
+	def numpy2em(array):
+		d = LocalEMData()
+		d.array = numpy.array(array, dtype=numpy.float32)
+		return d
+
+def installLocalEMAN2():
+	import types
+	module = types.ModuleType("EMAN2")
+	module.EMData = LocalEMData
+	module.EMNumPy = LocalEMNumPy
+	module.E2init = lambda argv, ppid=-1: 0
+	module.E2end = lambda logid: None
+	module.EMANVERSION = "local stand-in"
+	sys.modules["EMAN2"] = module
+	return module
+
+if localEMAN2: EMAN2 = installLocalEMAN2()
+
+import maskGold
+import simGold
+import goldAPI
+import stackIO
+
+def parse_command_line():
+	description = "benchmark the gold segmentation and the full masking pipeline of maskGold.py on particles from image files or on synthetic stacks"
+
+	parser = argparse.ArgumentParser(description=description)
+
+	parser.add_argument("imageFiles", nargs="*", help="input image file(s) for the segmentation benchmark. not used with --synthetic", default=[])
+
+	parser.add_argument("--imports", action="store_true", help="measure the import time of goldAPI.py and of the scripts in fresh interpreters. fails if importing goldAPI.py imports %s" % (", ".join(heavyLibraries)), default=False)
+
+	parser.add_argument("--maskweights", action="store_true", help="compare the --maskweight numpy and eman2 weights of maskGold.py on the true masks of a synthetic stack of each --gold shape other than none (first of --boxsizes). fails if they differ by more than --maskweight_tol or if the stack has no gold. requires EMAN2", default=False)
+
+	parser.add_argument("--circlemean", action="store_true", help="compare simGold.py --normalize numpy and eman2 (normalize.mask.circlemean) on a synthetic stack of each --gold shape other than none (first of --boxsizes) for a few particle radii. fails if they differ by more than --circlemean_tol. requires EMAN2", default=False)
+
+	parser.add_argument("--shapes", action="store_true", help="compare the unrotated and unscaled copies of goldAPI.ShapeTemplate (simGold.py --rotate, --markers, --size_jitter) with the shape arrays of goldAPI.shapeArray() for each of --boxsizes, each of them plus one and each shape, odd and even sizes. fails on any differing pixel", default=False)
+
+	parser.add_argument("--maskweight_tol", metavar="<x>", type=float, help="largest accepted difference of the --maskweights weights. default to 1e-3", default=1e-3)
+
+	parser.add_argument("--circlemean_tol", metavar="<x>", type=float, help="largest accepted difference of the --circlemean normalized particles. default to 1e-4", default=1e-4)
+
+	parser.add_argument("--import_repeat", metavar="<n>", type=int, help="number of fresh interpreters per module for --imports. default to 5", default=5)
+
+	parser.add_argument("--import_max", metavar="<ms>", type=float, help="with --imports, also fail if importing goldAPI.py takes longer than this. default to 0 (no limit)", default=0)
+
+	parser.add_argument("--synthetic", action="store_true", help="benchmark on synthetic stacks of --nptcl particles for each of --boxsizes and --gold", default=False)
+
+	parser.add_argument("--micrograph", action="store_true", help="compare maskGold.py --micrograph with maskGold.py on the stack of the boxes of a synthetic micrograph for each --gold shape other than none (first of --boxsizes). fails if the mean IoU of the masks is below --micrograph_iou or if the micrograph has no gold", default=False)
+
+	parser.add_argument("--micrograph_size", metavar="<n>", type=int, help="size of the synthetic micrograph of --micrograph. default to 1024", default=1024)
+
+	parser.add_argument("--micrograph_options", metavar="<options>", help="maskGold.py options of both runs of --micrograph. default to \"--skip_nogold 5\"", default="--skip_nogold 5")
+
+	parser.add_argument("--micrograph_iou", metavar="<x>", type=float, help="minimal mean IoU of the --micrograph masks against the masks of the boxes segmented one by one. default to 0.8", default=0.8)
+
+	parser.add_argument("--boxsizes", metavar="<n1,n2,...>", type=lambda s: [int(b) for b in s.split(",")], help="box sizes of the synthetic stacks. default to 128,256,384,512", default=[128, 256, 384, 512])
+
+	parser.add_argument("--gold", metavar="<s1,s2,...>", type=lambda s: s.split(","), help="gold shapes of the synthetic stacks (%s). default to none,circle,ellipse" % (",".join(goldShapes)), default=["none", "circle", "ellipse"])
+
+	parser.add_argument("--gold_fraction", metavar="<x>", type=float, help="fraction of the synthetic particles with a gold marker. default to 1", default=1.0)
+
+	parser.add_argument("--marker_pixel", metavar="<x>", type=float, help="gold marker intensity of the synthetic particles in units of the noise sigma. default to 5", default=5.0)
+
+	parser.add_argument("--seed", metavar="<n>", type=int, help="random seed of the synthetic stacks. default to 0", default=0)
+
+	parser.add_argument("--main_options", metavar="<options>", action="append", help="maskGold.py options for a run of the full pipeline on the synthetic stacks, e.g. \"--solver cg --bin 2 --skip_nogold 5 --processes 4 --prefetch 4\". can be repeated, the first run is the reference of --truth_drop. default to \"--processes 1\"", default=None)
+
+	parser.add_argument("--workdir", metavar="<dir>", help="directory for the synthetic stacks and outputs. default to the system temporary directory", default=None)
+
+	parser.add_argument("--keep", action="store_true", help="keep the synthetic stacks and outputs", default=False)
+
+	parser.add_argument("--solvers", metavar="<s1,s2,...>", type=lambda s: s.split(","), help="comma separated list of solvers (%s). default to all" % (",".join(maskGold.solverChoices)), default=maskGold.solverChoices)
+
+	parser.add_argument("--bins", metavar="<n1,n2,...>", type=lambda s: [int(b) for b in s.split(",")], help="comma separated list of binning factors for the coarse-to-fine segmentation (1, 2, 4). default to 1", default=[1])
+
+	parser.add_argument("--band", metavar="<n>", type=int, help="half width of the re-segmented band with binning. default to 4", default=4)
+
+	parser.add_argument("--iou_tol", metavar="<x>", type=float, help="report a failure (exit status 1) if the IoU of any particle against the bf mask is below this value. default to 0", default=0)
+
+	parser.add_argument("--truth_drop", metavar="<x>", type=float, help="with --synthetic, report a failure (exit status 1) if the mean IoU against the true masks of a solver/binning configuration or of a --main_options run is more than this below that of bf at full resolution or of the first --main_options run. default to 0.02", default=0.02)
+
+	parser.add_argument("--nptcl", metavar="<n>", type=int, help="number of particles to use (per synthetic stack). default to 20", default=20)
+
+	parser.add_argument("--solver_tol", metavar="<x>", type=float, help="convergence tolerance of the iterative solvers. default to 1e-3", default=1e-3)
+
+	parser.add_argument("--solver_autosize", metavar="<n>", type=int, help="largest box size solved with bf when solver=auto. default to 256", default=256)
+
+	parser.add_argument("--json", metavar="<filename>", help="also write the results to this json file, e.g. to track them over releases", default=None)
+
+	parser.add_argument("--verbose", metavar="<n>", type=int, help="verbose level. default to 1", default=1)
+
+	args=parser.parse_args()
+
+	if not args.synthetic and not args.imageFiles and not args.imports and not args.micrograph and not args.maskweights and not args.circlemean and not args.shapes:
+		parser.error("input image file(s), --synthetic, --micrograph, --maskweights, --circlemean, --shapes or --imports are required")
+	if args.imageFiles and not args.synthetic and localEMAN2:
+		parser.error("EMAN2 is required to read image files. use --synthetic")
+	if args.main_options is None: args.main_options = ["--processes 1"]
+	for solver in args.solvers:
+		if solver not in maskGold.solverChoices:
+			parser.error("unknown solver %s. choose from %s" % (solver, ",".join(maskGold.solverChoices)))
+	for binning in args.bins:
+		if binning not in [1, 2, 4]:
+			parser.error("binning must be 1, 2 or 4")
+	for gold in args.gold:
+		if gold not in goldShapes:
+			parser.error("unknown gold shape %s. choose from %s" % (gold, ",".join(goldShapes)))
+
+	return args
+
+
+if __name__== "__main__":
+	main()
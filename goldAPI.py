@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+# numpy API of maskGold.py and simGold.py for other python pipelines: gold segmentation, padded/soft mask weights,
+# non-gold normalization statistics and the simulated gold shapes on plain numpy arrays, one (ny, nx) image or a
+# (n, ny, nx) stack at a time
+#
+#   import goldAPI
+#   masks = goldAPI.findGoldMasks(stack, solver="auto", skip_nogold=5)
+#   mean, sigma = goldAPI.nonGoldStatistics(stack, masks)
+#   marker = goldAPI.shapeArray(128, "ellipse", [10, 16])
+#   markers = goldAPI.ShapeTemplate("triangle", [30]).rasterize(64, angles, scales)
+#
+# importing this module only imports numpy and the maskGold.py functions. scipy and the skimage submodules are
+# imported by the functions that need them on first use, EMAN2 only for file I/O (stackIO.py) and by the scripts.
+# benchGold.py --imports measures the import time and checks that no heavy library is imported
+
+import math, argparse
+
+import numpy
+
+import maskGold
+
+# the segmentation options of maskGold.py used by findGoldMasks() and their command line defaults
+segmentationDefaults = {"solver":"bf", "solver_tol":1e-3, "solver_autosize":256, "bin":1, "band":4,
+	"skip_nogold":0, "skip_size":5, "skip_minpixels":10}
+
+def segmentationOptions(options):
+	# the maskGold.py options namespace of the keyword options of findGoldMasks()
+	unknown = sorted(set(options)-set(segmentationDefaults))
+	if unknown:
+		raise TypeError("unknown segmentation option(s) %s. choose from %s" % (",".join(unknown), ",".join(sorted(segmentationDefaults))))
+	values = dict(segmentationDefaults)
+	values.update(options)
+	if values["solver"] not in maskGold.solverChoices:
+		raise ValueError("unknown solver %s. choose from %s" % (values["solver"], ",".join(maskGold.solverChoices)))
+	return argparse.Namespace(**values)
+
+def findGoldMask(image, **options):
+	# (ny, nx) uint8 gold mask (1 on gold) of one image. see findGoldMasks() for the options
+	return findGoldMasks(numpy.asarray(image)[numpy.newaxis], **options)[0]
+
+def findGoldMasks(stack, **options):
+	# (n, ny, nx) uint8 gold masks (1 on gold) of a (n, ny, nx) stack, segmented like maskGold.py: rescaled to
+	# [-1, 1], optional no-gold pre-screen, tv denoising (batched over the stack), Otsu markers and random walker.
+	# the options are the maskGold.py options of the same names (solver, solver_tol, solver_autosize, bin, band,
+	# skip_nogold, skip_size, skip_minpixels) with the same defaults
+	options = segmentationOptions(options)
+	stack = numpy.asarray(stack)
+	if stack.ndim!=3:
+		raise ValueError("a (n, ny, nx) stack is required, not an array of shape %s" % (stack.shape,))
+	if stack.dtype.kind!="f": stack = stack.astype(numpy.float32)
+	masks = numpy.zeros(stack.shape, dtype=numpy.uint8)
+	prepared = [maskGold.prescreenParticle(stack[j], options) for j in range(len(stack))]
+	batch = [j for j, (data, skipped) in enumerate(prepared) if not skipped and not maskGold.coarseToFine(data.shape, options)]
+	denoised = {}
+	if batch:
+		denoised = dict(zip(batch, maskGold.denoiseBatch(numpy.array([prepared[j][0] for j in batch]))))
+	for j, (data, skipped) in enumerate(prepared):
+		if not skipped: masks[j] = maskGold.findGoldMask(data, options, denoised.get(j))
+	return masks
+
+def maskWeights(masks, maskpad=0, masksoft=0):
+	# (n, ny, nx) float32 (1-mask) weights of the maskGold.py .masked output of (n, ny, nx) gold masks: 0 on the gold
+	# padded by maskpad pixels, rising to 1 over masksoft pixels, from exact euclidean distance transforms. this is
+	# maskGold.py --maskweight numpy, not yet validated against mask.distance of EMAN2
+	return maskGold.maskWeights(masks, argparse.Namespace(maskpad=maskpad, masksoft=masksoft, maskweight="numpy"))
+
+def nonGoldStatistics(images, masks):
+	# mean and standard deviation of the pixels outside the gold masks (0 = non-gold) of each image, as float64
+	# arrays of n values for a (n, ny, nx) stack or as floats for one (ny, nx) image. nan for an image without
+	# non-gold pixels. maskGold.py uses them on the images rescaled to [-1, 1]
+	images = numpy.asarray(images)
+	single = images.ndim==2
+	images = images.reshape(-1, images.shape[-2]*images.shape[-1])
+	nongold = (numpy.asarray(masks)==0).reshape(images.shape)
+	count = numpy.count_nonzero(nongold, axis=1).astype(numpy.float64)
+	with numpy.errstate(invalid="ignore", divide="ignore"):
+		mean = numpy.einsum("ij,ij->i", images, nongold, dtype=numpy.float64)/count
+		deviation = images-mean[:, numpy.newaxis]
+		sigma = numpy.sqrt(numpy.einsum("ij,ij,ij->i", deviation, deviation, nongold, dtype=numpy.float64)/count)
+	if single: return float(mean[0]), float(sigma[0])
+	return mean, sigma
+
+def normalizeNonGold(images, masks):
+	# the images with mean 0 and standard deviation 1 outside the gold masks, as float32
+	mean, sigma = nonGoldStatistics(images, masks)
+	images = numpy.asarray(images)
+	if images.ndim==3:
+		mean, sigma = mean[:, numpy.newaxis, numpy.newaxis], sigma[:, numpy.newaxis, numpy.newaxis]
+	return ((images-mean)/sigma).astype(numpy.float32)
+
+# hard circular mask weights of normalizeCircleMean() for each (boxsize, radius)
+circleWeightCache = {}
+
+def circleWeights(ny, nx, radius):
+	# 1 within the radius of the (nx/2, ny/2) center of EMAN2, the mask.sharp convention, and 0 outside, as a flat
+	# float32 array
+	key = (ny, nx, radius)
+	if key not in circleWeightCache:
+		y, x = numpy.ogrid[:ny, :nx]
+		weights = numpy.hypot(x - nx//2, y - ny//2) <= radius
+		circleWeightCache[key] = weights.astype(numpy.float32).ravel()
+	return circleWeightCache[key]
+
+def normalizeCircleMean(chunk, radius):
+	# batched numpy version of normalize.mask.circlemean with norm=1 and mask=0: each particle of the (n, ny, nx)
+	# float32 chunk minus the mean of its pixels within the hard circle of the radius, divided by the standard
+	# deviation of the whole particle like the sigma of EMAN2's normalize processors. masksoft only shapes the mask
+	# the processor applies with mask=1, so it does not change the result. the reductions accumulate in float64
+	# without a float64 copy of the chunk. the chunk is normalized in place. benchGold.py --circlemean checks it
+	# against the EMAN2 processor, which simGold.py uses by default
+	n, ny, nx = chunk.shape
+	weights = circleWeights(ny, nx, radius)
+	flat = chunk.reshape(n, ny*nx)
+	mean = numpy.einsum("ij,j->i", flat, weights, dtype=numpy.float64) / weights.sum(dtype=numpy.float64)
+	sigma = flat.std(axis=1, dtype=numpy.float64)
+	sigma[sigma == 0] = 1
+	flat -= mean.astype(numpy.float32)[:, numpy.newaxis]
+	flat /= sigma.astype(numpy.float32)[:, numpy.newaxis]
+	return chunk
+
+# the gold shapes of simGold.py as (boxsize, boxsize) uint8 arrays, 1 on the gold, centered like the simGold.py masks.
+# a shape that does not fit in the box raises a ValueError
+
+# the size options of each shape, in the order of the arguments of its shape function
+shapeOptions = {"triangle":["triangle_side"], "rectangle":["rect_width", "rect_height"], "square":["square_width"],
+	"diamond":["diamond_radius"], "octagon":["octagon_m", "octagon_n"], "star":["star_size"],
+	"ellipse":["ellipse_yradius", "ellipse_xradius"], "circle":["circle_radius"]}
+
+def shapeArray(boxsize, shape, sizes):
+	# the gold shape with the values of its size options
+	functions = {"triangle":triangleArray, "rectangle":rectArray, "square":squareArray, "diamond":diamondArray,
+		"octagon":octArray, "star":starArray, "ellipse":ellipseArray, "circle":circleArray}
+	if shape not in functions:
+		raise ValueError("unknown shape %s. choose from %s" % (shape, ",".join(sorted(functions))))
+	return functions[shape](boxsize, *sizes)
+
+def padShape(array, boxsize):
+	# pad the (m, n) shape to the box with its center pixel one pixel (odd m) or half a pixel (even m) before the
+	# (boxsize/2, boxsize/2) center, as simGold.py for even boxes, and the same for odd boxes: boxsize/2-(m+1)/2
+	# zeros before, the rest after
+	pads = []
+	for m in array.shape:
+		before = boxsize//2 - (m+1)//2
+		pads.append((before, boxsize - m - before))
+	return numpy.pad(array, pads, mode="constant")
+
+def circleArray(boxsize, circle_radius):
+	# the pixels within circle_radius of the (boxsize/2, boxsize/2) center, the mask.sharp convention of EMAN2
+	y, x = numpy.ogrid[:boxsize, :boxsize]
+	return (numpy.hypot(x - boxsize//2, y - boxsize//2) <= circle_radius).astype(numpy.uint8)
+
+def ellipseArray(boxsize, ellipse_yradius, ellipse_xradius):
+	from skimage.draw import ellipse
+	if (boxsize <= ellipse_yradius * 2 or boxsize <= ellipse_xradius * 2):
+		raise ValueError("ellipse_xradius or ellipse_yradius is larger than the boxsize of particles.")
+	size = max([ellipse_xradius, ellipse_yradius]) * 2 + 4
+	array = numpy.zeros((size, size), dtype=numpy.uint8)
+	rr, cc = ellipse(size//2, size//2, ellipse_yradius, ellipse_xradius)
+	array[rr, cc] = 1
+	return padShape(array, boxsize)
+
+def starArray(boxsize, star_size):
+	# 8 vertices, overlap of a square of size 2*star_size+1 with its 45 degree rotated version
+	from skimage.morphology import star
+	if (boxsize <= star_size):
+		raise ValueError("star size is larger than the boxsize of particles.")
+	return padShape(star(star_size, dtype=numpy.uint8), boxsize)
+
+def octArray(boxsize, octagon_m, octagon_n):
+	# horizontal and vertical sides of octagon_m pixels, slanted sides of octagon_n pixels height and width
+	from skimage.morphology import octagon
+	if (boxsize <= octagon_n * 2 or boxsize <= octagon_m):
+		raise ValueError("(2 * the slanted sides) or (the horizontal and vertical sides) is larger than the boxsize of particles.")
+	return padShape(octagon(octagon_m, octagon_n, dtype=numpy.uint8), boxsize)
+
+def diamondArray(boxsize, diamond_radius):
+	# the pixels within diamond_radius city block distance of the center
+	from skimage.morphology import diamond
+	if (boxsize <= (diamond_radius * 2 + 1)):
+		raise ValueError("the width of the square cannot be larger than the boxsize of particles.")
+	return padShape(diamond(diamond_radius, dtype=numpy.uint8), boxsize)
+
+def squareArray(boxsize, square_width):
+	# odd and even square_width are allowed
+	from skimage.morphology import square
+	if (boxsize <= square_width):
+		raise ValueError("the width of the square cannot be larger than the boxsize of particles.")
+	return padShape(square(square_width, dtype=numpy.uint8), boxsize)
+
+def rectArray(boxsize, width, height):
+	# height rows of width pixels
+	from skimage.morphology import rectangle
+	if (boxsize <= width or boxsize <= height):
+		raise ValueError("the width or height of the rectangle cannot be larger than the boxsize of particles.")
+	return padShape(rectangle(height, width, dtype=numpy.uint8), boxsize)
+
+def triangleArray(boxsize, side):
+	# equilateral triangle with a horizontal base, centered on the box center
+	from skimage.draw import polygon
+	if (boxsize <= side + 2):
+		raise ValueError("the side of the triangle cannot be larger than the boxsize of particles.")
+	array = numpy.zeros((boxsize, boxsize), dtype=numpy.uint8)
+	x0 = boxsize//2 - side//2
+	x1 = boxsize//2
+	x2 = boxsize//2 + side//2
+	y0 = boxsize//2 - side * (math.sqrt(3))/6
+	y1 = boxsize//2 + side * (math.sqrt(3))/3
+	x = numpy.array([x0, x1, x2, x0])
+	y = numpy.array([y0, y1, y0, y0])
+	rr, cc = polygon(y, x)
+	array[rr, cc] = 1
+	return array
+
+class ShapeTemplate(object):
+	# a gold shape in continuous (x, y) pixel coordinates around its center, for the batched rasterization of rotated
+	# and scaled copies: a union of convex polygons given as edge tables (a point is inside a polygon if
+	# normals.(x, y) <= offsets for all its edges) or an ellipse given by its radii. the sizes are the size options of
+	# shapeArray(). the outlines, centers and tie rules follow the shape arrays, so that an unrotated and unscaled copy
+	# is the shapeArray() of an odd or even boxsize pixel for pixel (benchGold.py --shapes)
+	def __init__(self, shape, sizes):
+		if shape not in shapeOptions:
+			raise ValueError("unknown shape %s. choose from %s" % (shape, ",".join(sorted(shapeOptions))))
+		self.shape = shape
+		self.polygons = []
+		self.radii = None
+		# the pixel, relative to the box center, of the center of the shape. the circle, ellipse and triangle are
+		# drawn around the box center, padShape() centers m pixels on the boxsize//2-(m+1)//2+(m-1)/2 pixel: one
+		# pixel before the box center for odd m, half a pixel for even m, for odd and even boxes
+		self.center = (0.0, 0.0)
+		if shape == "circle":
+			self.radii = (sizes[0], sizes[0])
+		elif shape == "ellipse":
+			self.radii = (sizes[1], sizes[0])
+		elif shape == "triangle":
+			side = sizes[0]
+			h = side*math.sqrt(3)
+			self.addPolygon([(-(side//2), -h/6), (0, h/3), (side//2, -h/6)], halfOpen=True)
+		elif shape in ["rectangle", "square"]:
+			width, height = sizes if shape == "rectangle" else (sizes[0], sizes[0])
+			self.center = (padCenter(width), padCenter(height))
+			self.addPolygon(boxVertices(width/2., height/2.))
+		elif shape == "diamond":
+			self.center = (1.0, 1.0)
+			self.addPolygon(diamondVertices(sizes[0]+0.5))
+		elif shape == "octagon":
+			m, n = sizes
+			# the slanted sides through the pixel centers of the corners of skimage.morphology.octagon()
+			a, b = (m+2*n)/2., (m-1)/2.
+			self.center = (padCenter(m), padCenter(m))
+			self.addPolygon([(b, a), (a, b), (a, -b), (b, -a), (-b, -a), (-a, -b), (-a, b), (-b, a)])
+		elif shape == "star":
+			# skimage.morphology.star(): the 2a+1 square and the diamond of the full 2a+1+2*(a//2) width
+			a = sizes[0]
+			self.center = (1.0, 1.0)
+			self.addPolygon(boxVertices(a+0.5, a+0.5))
+			self.addPolygon(diamondVertices(a+a//2+0.5))
+		# the largest distance of the shape from the (size//2, size//2) pixel of rasterize() at scale 1
+		if self.radii:
+			self.radius = float(max(self.radii))
+		else:
+			self.radius = max(math.hypot(x, y) for normals, offsets, vertices in self.polygons for x, y in vertices)
+		self.radius += math.hypot(*self.center)
+
+	def addPolygon(self, vertices, halfOpen=False):
+		# edge table of a convex polygon: the outward normal of each edge and its distance to the center. the pixel
+		# centers on an edge are inside, or with halfOpen only on the edges facing -x or -y, like the crossing test
+		# of skimage.draw.polygon(). the offsets are moved by a tie tolerance far below the pixel spacing and above the
+		# rounding errors of the float64 edge tests, so that these ties are decided the same way for every copy
+		vertices = numpy.array(vertices, dtype=numpy.float64)
+		edges = numpy.roll(vertices, -1, axis=0)-vertices
+		normals = numpy.column_stack((edges[:, 1], -edges[:, 0]))
+		normals /= numpy.hypot(normals[:, 0], normals[:, 1])[:, numpy.newaxis]
+		offsets = numpy.einsum("ij,ij->i", normals, vertices)
+		flip = offsets<0
+		normals[flip] *= -1
+		offsets[flip] *= -1
+		exclusive = numpy.zeros(len(offsets), dtype=bool)
+		if halfOpen:
+			exclusive = (normals[:, 0]>tieTolerance) | ((abs(normals[:, 0])<=tieTolerance) & (normals[:, 1]>0))
+		offsets += numpy.where(exclusive, -tieTolerance, tieTolerance)
+		self.polygons.append((normals, offsets, vertices))
+
+	def rasterize(self, size, angles, scales, shifts=None):
+		# (n, size, size) bool masks of n copies of the shape rotated by angles (radians), scaled by scales and centered
+		# on the (size//2, size//2) pixel, or shifted from it by the integer (dx, dy) shifts. a pixel is inside if its
+		# center is. each edge test is linear in x and y, so it is one comparison of a (n, 1, size) and a (n, size, 1)
+		# array per edge for all copies at once, without rotating the coordinates of the pixels
+		n = len(angles)
+		c = size//2
+		x = numpy.tile(numpy.arange(-c, size-c, dtype=numpy.float64)+self.center[0], (n, 1))
+		y = numpy.tile(numpy.arange(-c, size-c, dtype=numpy.float64)+self.center[1], (n, 1))
+		if shifts is not None:
+			x -= shifts[:, 0:1]
+			y -= shifts[:, 1:2]
+		scales = numpy.asarray(scales, dtype=numpy.float64)
+		cos = numpy.cos(angles)/scales
+		sin = numpy.sin(angles)/scales
+		# the coordinates in the frame of each copy are u = cos*x+sin*y, v = cos*y-sin*x
+		if self.radii:
+			# (n, size, size) u and v, tested with the expressions of circleArray() and skimage.draw.ellipse() so
+			# that the ties of an unrotated copy, on the circle or ellipse, are decided like in the shape arrays
+			xradius, yradius = self.radii
+			cos, sin = cos[:, numpy.newaxis, numpy.newaxis], sin[:, numpy.newaxis, numpy.newaxis]
+			x, y = x[:, numpy.newaxis, :], y[:, :, numpy.newaxis]
+			u = cos*x+sin*y
+			v = cos*y-sin*x
+			if self.shape == "circle":
+				return numpy.hypot(u, v) <= xradius
+			return (v/yradius)**2+(u/xradius)**2 < 1
+		inside = numpy.zeros((n, size, size), dtype=bool)
+		for normals, offsets, vertices in self.polygons:
+			polygon = numpy.ones((n, size, size), dtype=bool)
+			for (nx, ny), offset in zip(normals, offsets):
+				a = (nx*cos-ny*sin)[:, numpy.newaxis]
+				b = (nx*sin+ny*cos)[:, numpy.newaxis]
+				polygon &= (b*y)[:, :, numpy.newaxis] <= (offset-a*x)[:, numpy.newaxis, :]
+			inside |= polygon
+		return inside
+
+# distance in pixels below which a pixel center counts as on an edge of a ShapeTemplate polygon
+tieTolerance = 1e-9
+
+def padCenter(m):
+	# ShapeTemplate.center of padShape() along an axis of m pixels
+	return 0.5*(1+m%2)
+
+def boxVertices(a, b):
+	return [(-a, -b), (a, -b), (a, b), (-a, b)]
+
+def diamondVertices(r):
+	return [(r, 0), (0, r), (-r, 0), (0, -r)]
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# per-stage timing of maskGold.py: wall time, cpu time and memory of each processing stage of each particle,
+# summarized per image file into machine readable .profile.json and .profile.csv files. the memory of a stage is
+# the resident memory of the process (writer or pool worker) at the end of the stage and the peak resident memory
+# of that process so far (ru_maxrss): a high-water mark that may have been reached in an earlier stage
+
+import os, time, resource, contextlib, json, csv
+
+import numpy
+
+# the profile of the particle being processed in this process. None when profiling is disabled
+current = None
+
+@contextlib.contextmanager
+def stage(name):
+	profile = current
+	if profile is None:
+		yield
+		return
+	wall0, cpu0 = time.time(), cpuTime()
+	try:
+		yield
+	finally:
+		addStage(profile, name, time.time()-wall0, cpuTime()-cpu0, rssMB())
+
+def newProfile(index):
+	# stages: name -> [wall time (s), cpu time (s), memory at the end (MB), peak memory of the process (MB)]
+	return {"index":index, "stages":{}}
+
+def addStage(profile, name, wall, cpu, rss):
+	# called in the process that ran the stage, which records its own peak memory. ru_maxrss is updated lazily by
+	# the kernel and can lag behind a resident memory just read from /proc
+	peak = max(peakMB(), rss)
+	if name in profile["stages"]:
+		s = profile["stages"][name]
+		s[0] += wall
+		s[1] += cpu
+		s[2] = max(s[2], rss)
+		s[3] = max(s[3], peak)
+	else:
+		profile["stages"][name] = [wall, cpu, rss, peak]
+
+def cpuTime():
+	t = os.times()
+	return t[0]+t[1]
+
+def rssMB():
+	# resident memory of this process at the end of the stage. /proc is Linux only, otherwise the peak so far
+	try:
+		pages = int(open("/proc/self/statm").read().split()[1])
+		return pages*resource.getpagesize()/1048576.
+	except (IOError, ValueError, IndexError):
+		return peakMB()
+
+def peakMB():
+	# peak resident memory of this process so far (ru_maxrss is in KB on Linux)
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+class StackProfile(object):
+	# collects the particle profiles of one image file
+	def __init__(self, imageFile):
+		self.imageFile = imageFile
+		self.profiles = []
+		self.startTime = time.time()
+
+	def add(self, profiles):
+		self.profiles += profiles
+
+	def summary(self, nSlowest=10):
+		stageNames = sorted(set(name for p in self.profiles for name in p["stages"]))
+		stages = {}
+		for name in stageNames:
+			wall = numpy.array([p["stages"][name][0] for p in self.profiles if name in p["stages"]])
+			cpu = numpy.array([p["stages"][name][1] for p in self.profiles if name in p["stages"]])
+			rss = [p["stages"][name][2] for p in self.profiles if name in p["stages"]]
+			peak = [p["stages"][name][3] for p in self.profiles if name in p["stages"]]
+			stages[name] = {"count":len(wall), "wall_total":wall.sum(), "cpu_total":cpu.sum(), "wall_mean":wall.mean(),
+				"wall_p50":numpy.percentile(wall, 50), "wall_p90":numpy.percentile(wall, 90), "wall_p99":numpy.percentile(wall, 99),
+				"wall_max":wall.max(), "memory_end_max_mb":max(rss), "memory_peak_mb":max(peak)}
+		totals = sorted(((particleWall(p), p) for p in self.profiles), key=lambda x: -x[0])
+		slowest = [ {"index":p["index"], "wall":w, "stages":dict((k, v[0]) for k, v in p["stages"].items())} for w, p in totals[:nSlowest] ]
+		particleTimes = [w for w, p in totals] or [0]
+		# the largest peak of a single process, the writer or a pool worker, not their sum
+		processPeakMB = max([s["memory_peak_mb"] for s in stages.values()] + [peakMB()])
+		return {"imageFile":self.imageFile, "particles":len(self.profiles), "elapsed":time.time()-self.startTime,
+			"particle_wall_total":sum(particleTimes), "particle_wall_p50":numpy.percentile(particleTimes, 50),
+			"particle_wall_p90":numpy.percentile(particleTimes, 90), "particle_wall_p99":numpy.percentile(particleTimes, 99),
+			"writer_peak_memory_mb":peakMB(), "process_peak_memory_mb":processPeakMB,
+			"stages":stages, "slowest":slowest}
+
+	def write(self, baseName):
+		summary = self.summary()
+		with open("%s.profile.json" % (baseName), "w") as fp:
+			json.dump(summary, fp, indent=1, sort_keys=True, default=float)
+		stageNames = sorted(summary["stages"])
+		with open("%s.profile.csv" % (baseName), "wb") as fp:
+			writer = csv.writer(fp)
+			writer.writerow(["index", "wall"] + ["%s_wall" % (name) for name in stageNames] + ["%s_cpu" % (name) for name in stageNames] + ["memory_end_mb", "memory_peak_mb"])
+			for p in sorted(self.profiles, key=lambda p: p["index"]):
+				s = p["stages"]
+				writer.writerow([p["index"], "%.6f" % (particleWall(p))] + ["%.6f" % (s[name][0] if name in s else 0) for name in stageNames] +
+					["%.6f" % (s[name][1] if name in s else 0) for name in stageNames] + ["%.1f" % (max([v[2] for v in s.values()] or [0])),
+					"%.1f" % (max([v[3] for v in s.values()] or [0]))])
+		return summary
+
+def particleWall(profile):
+	return sum(s[0] for s in profile["stages"].values())
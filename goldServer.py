@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+# persistent service for maskGold.py, simGold.py and sweepGold.py: the server imports the scripts and EMAN2, skimage
+# and scipy (maskGold.loadLibraries()) once and runs each job (program + command line options) in a process forked
+# from it, so that a job does not pay for the interpreter and library startup. jobs are submitted over a local Unix
+# socket, up to --workers jobs run at the same time, the others wait for a free slot. the job processes are forked by
+# a single dispatcher thread, never by the threads serving the requests. a finished job is dropped from the jobs table
+# once its final status has been reported (the reply of a waiting run, a status request) or after --job_ttl seconds
+#
+#   goldServer.py --serve --workers 4 &
+#   goldServer.py maskGold stack.hdf --maskpad 2     # runs the job, prints its status and timings
+#   goldServer.py --status
+#   goldServer.py --shutdown
+#
+# the protocol is one json request and one json reply per connection, each on one line:
+#   {"cmd":"run", "program":<p>, "args":[...], "cwd":<dir>, "wait":true|false, "log":<file>}
+#   {"cmd":"status", "id":<job id or null for all jobs>}    # finished jobs are dropped once reported
+#   {"cmd":"shutdown"}
+
+import os, sys, argparse, socket, json, time, threading, tempfile, multiprocessing, SocketServer, Queue
+
+programs = ["maskGold", "simGold", "sweepGold"]
+
+defaultSocket = os.path.join(tempfile.gettempdir(), "goldServer-%d.sock" % (os.getuid()))
+
+def main():
+	args = parse_command_line()
+
+	if args.serve:
+		serve(args)
+		return
+
+	if args.shutdown:
+		reply = request(args.socket, {"cmd":"shutdown"})
+	elif args.status:
+		reply = request(args.socket, {"cmd":"status", "id":args.id})
+	else:
+		log = os.path.abspath(args.log) if args.log else None
+		reply = request(args.socket, {"cmd":"run", "program":args.program, "args":args.args, "cwd":os.getcwd(), "wait":not args.nowait, "log":log})
+	print json.dumps(reply, indent=1, sort_keys=True)
+	if "error" in reply: sys.exit(-1)
+	if reply.get("status") == "failed": sys.exit(reply.get("exitcode") or 1)
+
+def request(path, message):
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(path)
+	except socket.error, e:
+		return {"error":"cannot connect to the server at %s: %s" % (path, e)}
+	sock.sendall(json.dumps(message)+"\n")
+	reply = sock.makefile().readline()
+	sock.close()
+	return json.loads(reply)
+
+def serve(args):
+	if os.path.exists(args.socket):
+		# a status request of a job that does not exist, so that the finished jobs of a running server stay unreported
+		if not request(args.socket, {"cmd":"status", "id":0}).get("error", "").startswith("cannot connect"):
+			print "ERROR: a server is already running at %s" % (args.socket)
+			sys.exit(-1)
+		os.remove(args.socket)	# left over by a server that did not exit cleanly
+	if not os.path.isdir(args.logdir): os.makedirs(args.logdir)
+
+	t0 = time.time()
+	for program in programs: __import__(program)
+	sys.modules["maskGold"].loadLibraries()
+	startupTime = time.time()-t0
+
+	server = GoldServer(args.socket, args.workers, args.logdir, startupTime, args.job_ttl)
+	print "goldServer: %s, %d workers, libraries loaded in %.2f s, job logs in %s" % (args.socket, args.workers, startupTime, args.logdir)
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if os.path.exists(args.socket): os.remove(args.socket)
+
+class GoldServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	# seconds between the checks of the dispatcher for finished jobs
+	pollInterval = 0.1
+
+	def __init__(self, path, workers, logdir, startupTime, jobTTL=3600):
+		SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+		self.workers = workers
+		self.logdir = logdir
+		self.startupTime = startupTime
+		self.jobTTL = jobTTL
+		self.jobs = {}
+		self.finished = {}	# job id -> event set when the job is finished
+		self.lock = threading.Lock()
+		self.nextId = 1
+		self.queue = Queue.Queue()
+		self.stopping = threading.Event()
+		self.dispatcher = threading.Thread(target=self.dispatch)
+		self.dispatcher.daemon = True
+		self.dispatcher.start()
+
+	def submit(self, message):
+		program = message.get("program")
+		if program not in programs:
+			return {"error":"unknown program %s. choose from %s" % (program, ",".join(programs))}
+		with self.lock:
+			jobId = self.nextId
+			self.nextId += 1
+			job = {"id":jobId, "program":program, "args":[str(a) for a in message.get("args", [])], "cwd":message.get("cwd") or os.getcwd(),
+				"log":message.get("log") or os.path.join(self.logdir, "%d.%s.log" % (jobId, program)), "status":"queued",
+				"submitted":time.time(), "exitcode":None, "queued_seconds":None, "run_seconds":None}
+			self.jobs[jobId] = job
+			self.finished[jobId] = threading.Event()
+			finished = self.finished[jobId]
+		self.queue.put(job)
+		if not message.get("wait", True):
+			with self.lock: return dict(job)
+		finished.wait()
+		# the final status is in the reply, the job is not kept for status requests
+		with self.lock:
+			self.evict(jobId)
+			return dict(job)
+
+	def dispatch(self):
+		# the only thread that forks the job processes: the request threads only queue the jobs and wait for their
+		# events, so that no process is forked while a request thread is in the middle of something
+		running = []
+		while not self.stopping.is_set():
+			for job, process in running[:]:
+				if process.is_alive(): continue
+				process.join()
+				running.remove((job, process))
+				with self.lock:
+					job["exitcode"] = process.exitcode
+					job["run_seconds"] = time.time()-job["started"]
+					job["status"] = "done" if process.exitcode==0 else "failed"
+					job["finished"] = time.time()
+					self.finished[job["id"]].set()
+			self.expire()
+			if len(running)>=self.workers:
+				time.sleep(self.pollInterval)
+				continue
+			try:
+				job = self.queue.get(timeout=self.pollInterval)
+			except Queue.Empty:
+				continue
+			with self.lock:
+				job["started"] = time.time()
+				job["status"] = "running"
+				job["queued_seconds"] = job["started"]-job["submitted"]
+			process = multiprocessing.Process(target=runJob, args=(job["program"], job["args"], job["cwd"], job["log"]))
+			try:
+				process.start()
+			except Exception, e:
+				with self.lock:
+					job["status"] = "failed"
+					job["error"] = "%s: %s" % (e.__class__.__name__, e)
+					job["finished"] = time.time()
+					self.finished[job["id"]].set()
+				continue
+			running.append((job, process))
+
+	def server_close(self):
+		# the queued jobs are not started, the running ones are joined at exit by multiprocessing
+		self.stopping.set()
+		self.dispatcher.join()
+		SocketServer.UnixStreamServer.server_close(self)
+
+	def evict(self, jobId):
+		# called with the lock held
+		del self.jobs[jobId]
+		del self.finished[jobId]
+
+	def expire(self):
+		# drop the finished jobs whose status was not requested within --job_ttl seconds
+		with self.lock:
+			now = time.time()
+			for job in self.jobs.values():
+				if "finished" in job and now-job["finished"]>self.jobTTL: self.evict(job["id"])
+
+	def status(self, jobId=None):
+		# the finished jobs are reported once: they are dropped from the jobs table by this request
+		with self.lock:
+			if jobId is not None:
+				if jobId not in self.jobs: return {"error":"no job %s (never submitted, or finished and already reported)" % (jobId)}
+				job = dict(self.jobs[jobId])
+				if "finished" in job: self.evict(jobId)
+				return job
+			jobs = [dict(job) for job in sorted(self.jobs.values(), key=lambda job: job["id"])]
+			for job in jobs:
+				if "finished" in job: self.evict(job["id"])
+		running = sum(job["status"]=="running" for job in jobs)
+		queued = sum(job["status"]=="queued" for job in jobs)
+		return {"workers":self.workers, "startup_seconds":self.startupTime, "running":running, "queued":queued, "jobs":jobs}
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		try:
+			message = json.loads(self.rfile.readline())
+			cmd = message.get("cmd")
+			if cmd == "run":
+				reply = self.server.submit(message)
+			elif cmd == "status":
+				jobId = message.get("id")
+				reply = self.server.status() if jobId is None else self.server.status(jobId)
+			elif cmd == "shutdown":
+				# shutdown() waits for serve_forever() to return, so it must not run in the thread serving this request
+				threading.Thread(target=self.server.shutdown).start()
+				reply = {"status":"shutting down"}
+			else:
+				reply = {"error":"unknown command %s" % (cmd)}
+		except Exception, e:
+			reply = {"error":"%s: %s" % (e.__class__.__name__, e)}
+		self.wfile.write(json.dumps(reply)+"\n")
+
+def runJob(program, args, cwd, log):
+	# in the forked job process: the libraries are already imported by the server
+	os.chdir(cwd)
+	fd = os.open(log, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0644)
+	sys.stdout.flush()
+	sys.stderr.flush()
+	os.dup2(fd, 1)
+	os.dup2(fd, 2)
+	os.close(fd)
+	sys.argv = ["%s.py" % (program)] + args
+	sys.modules[program].main()
+
+def parse_command_line():
+	description = "persistent service running maskGold.py, simGold.py and sweepGold.py jobs without the interpreter and library startup of each run"
+
+	parser = argparse.ArgumentParser(description=description)
+
+	parser.add_argument("program", nargs="?", choices=programs, help="program of the job to submit", default=None)
+
+	parser.add_argument("args", nargs=argparse.REMAINDER, help="command line options of the job", default=[])
+
+	parser.add_argument("--socket", metavar="<path>", help="Unix socket of the server. default to %s" % (defaultSocket), default=defaultSocket)
+
+	parser.add_argument("--serve", action="store_true", help="run the server", default=False)
+
+	parser.add_argument("--workers", metavar="<n>", type=int, help="with --serve, number of jobs run at the same time. default to 1", default=1)
+
+	parser.add_argument("--job_ttl", metavar="<seconds>", type=float, help="with --serve, seconds a finished job whose status was never reported is kept for --status. default to 3600", default=3600)
+
+	parser.add_argument("--logdir", metavar="<dir>", help="with --serve, directory of the job logs (stdout and stderr of the job). default to %s" % (os.path.join(tempfile.gettempdir(), "goldServer")), default=os.path.join(tempfile.gettempdir(), "goldServer"))
+
+	parser.add_argument("--nowait", action="store_true", help="return as soon as the job is queued instead of when it is finished", default=False)
+
+	parser.add_argument("--log", metavar="<filename>", help="log file of the submitted job. default to <logdir>/<job id>.<program>.log", default=None)
+
+	parser.add_argument("--status", action="store_true", help="print the status and timings of all jobs, or of the --id job. a finished job is reported once", default=False)
+
+	parser.add_argument("--id", metavar="<n>", type=int, help="job id for --status", default=None)
+
+	parser.add_argument("--shutdown", action="store_true", help="stop the server", default=False)
+
+	args=parser.parse_args()
+
+	if not (args.serve or args.status or args.shutdown or args.program):
+		parser.error("a program to run, --serve, --status or --shutdown is required")
+
+	return args
+
+if __name__== "__main__":
+	main()
@@ -3,85 +3,1020 @@
 # by Wen Jiang, 2014-06-30
 # $Id$
 
-import os, sys, argparse
+import os, sys, re, argparse, itertools, multiprocessing, time, threading, Queue, json, hashlib, errno
 
-import EMAN2
 import numpy
-from skimage import exposure
-from skimage.segmentation import random_walker
-from skimage.restoration import denoise_tv_chambolle
-from skimage.filter import threshold_otsu
+import stackIO
+import goldProfile
 
-def main():
-	args= parse_command_line()
+# EMAN2, scipy and the skimage submodules are imported by the functions that use them, on first use, so that
+# importing this module (e.g. through goldAPI.py) stays cheap. main() and goldServer.py load them up front with
+# loadLibraries() so that the worker processes and jobs inherit them instead of importing them each
+libraries = ["EMAN2", "scipy.ndimage", "skimage.exposure", "skimage.segmentation", "skimage.restoration", "skimage.filter"]
 
-	logid=EMAN2.E2init(sys.argv, -1)
-	
+def loadLibraries():
+	for library in libraries: __import__(library)
+
+def main(argv=None):
+	import EMAN2
+	args= parse_command_line(argv)
+	loadLibraries()
+
+	logid=EMAN2.E2init(sys.argv if argv is None else [sys.argv[0]]+list(argv), -1)
+
+	if args.micrograph:
+		micrographMain(args)
+		EMAN2.E2end(logid)
+		return
+
+	if args.merge:
+		merged = mergeMain(args)
+		EMAN2.E2end(logid)
+		if not merged: sys.exit(1)
+		return
+
+	# each task is a chunk of consecutive particles of one image file. imap() returns the results in the input order
+	# so that the chunks are written in large blocks and particle i always lands at index i of the output files
+	# (index i-start of the shard output files with --shard/--range). with --resume, the particles of each image 
+	# file start at the first one not done by the previous run
+	stacks = {}
+	tasks = ( (ifi, imageFile, start, min(start+args.chunksize, stop), None, cacheFile) for ifi, imageFile, stop, cacheFile, first in imageFileList(args, stacks) for start in range(first, stop, args.chunksize) )
+
+	if args.prefetch:
+		# pipeline mode: a reader thread reads the chunks ahead, the workers compute and a writer thread writes.
+		# at most --prefetch chunks are held in memory between reading and writing
+		slots = threading.Semaphore(args.prefetch)
+		errors = []
+		readTimes = {}
+		readQueue = Queue.Queue()
+		reader = threading.Thread(target=readChunks, args=(tasks, readQueue, slots, errors, readTimes))
+		reader.daemon = True
+		reader.start()
+		tasks = iter(readQueue.get, None)
+
+	if args.processes>1:
+		pool = multiprocessing.Pool(args.processes, initWorker, (args,))
+		results = pool.imap(processChunk, tasks)
+	else:
+		pool = None
+		initWorker(args)
+		results = itertools.imap(processChunk, tasks)
+
+	if args.prefetch:
+		writeQueue = Queue.Queue()
+		writer = threading.Thread(target=writeResults, args=(iter(writeQueue.get, None), args, stacks, slots, errors, readTimes))
+		writer.daemon = True
+		writer.start()
+		for result in results:
+			writeQueue.put(result)
+		writeQueue.put(None)
+		writer.join()
+		reader.join()
+		if errors: raise errors[0]
+	else:
+		writeResults(results, args, stacks)
+
+	if pool:
+		pool.close()
+		pool.join()
+
+	EMAN2.E2end(logid)
+
+def readChunks(tasks, queue, slots, errors, readTimes):
+	try:
+		stacks = {}
+		for ifi, imageFile, start, stop, chunk, cacheFile in tasks:
+			slots.acquire()
+			t0 = time.time()
+			if imageFile not in stacks: stacks = {imageFile:stackIO.openStack(imageFile)}
+			chunk = stacks[imageFile].read(start, stop)
+			readTimes[(imageFile, start)] = time.time()-t0
+			queue.put( (ifi, imageFile, start, stop, chunk, cacheFile) )
+	except Exception, e:
+		errors.append(e)
+	finally:
+		queue.put(None)
+
+def writeResults(results, args, stacks, slots=None, errors=None, readTimes={}):
+	import EMAN2
+	prevFile = None
+	startTime = time.time()
+	for result in results:
+		ifi, imageFile, start, norm, weight, profiles = result.ifi, result.imageFile, result.start, result.norm, result.weight, result.profiles
+		if errors:
+			# drain the queue after an error so that the reader and the workers are not blocked
+			if slots: slots.release()
+			continue
+		try:
+			if imageFile != prevFile:
+				if prevFile: 
+					closeOutputs(*outputs)
+					if shard: writeShardManifest(prevFile, stacks[prevFile], args)
+					if checkpoint: checkpoint.save(stop-offset, [])
+					reportThroughput(prevFile, nDone, nSkipped, nCached, startTime, args)
+					if args.profile: writeProfile(stackProfile, imageBaseName, args)
+					startTime = time.time()
+				prevFile = imageFile
+				nDone = 0
+				nSkipped = 0
+				nCached = 0
+				# the output files of a shard hold its particles [offset, stop) at indexes [0, stop-offset)
+				shard, offset, stop = stacks[imageFile]["shard"], stacks[imageFile]["start"], stacks[imageFile]["stop"]
+				imageBaseName = outputBase(imageFile, shard)
+				if args.profile: stackProfile = goldProfile.StackProfile(imageFile)
+				first = stacks[imageFile]["first"]
+				checkpoint = stacks[imageFile]["checkpoint"]
+				normStack = stackIO.createStack(outputFiles(imageFile, args, shard)[0], norm.shape[1:], append=first>offset)
+				maskedStack = stackIO.createStack(outputFiles(imageFile, args, shard)[1], norm.shape[1:], append=first>offset)
+				outputs = [normStack, maskedStack]
+				if args.savemask:
+					maskStack = goldMaskOutput(imageFile, stop-offset, norm.shape[1:], args, append=first>offset, shard=shard)
+					outputs.append(maskStack)
+				if result.cacheFile:
+					maskCache = stackIO.MaskStack(result.cacheFile, mode="r+")
+					outputs.append(maskCache)
+				if args.verbose:
+					print "Start processing image file %d/%d: %s (%d particles)" % (ifi+1, len(args.imageFiles), imageFile, stacks[imageFile]["nImage"])
+					if shard: print "\t%s: particles %d-%d to %s.*" % (shardName(args), offset, stop-1, imageBaseName)
+					if first>offset: print "\tresuming at particle %d" % (first)
+					if args.verbose<0:
+						args.debugFile = "%s.debug.hdf" % (imageBaseName)
+
+			if args.verbose<0 or args.verbose>1:
+				for i in range(start, start+len(norm)):
+					print "Processing image file %d/%d: %s:%d" % (ifi+1, len(args.imageFiles), imageFile, i)
+
+			t0, c0 = time.time(), goldProfile.cpuTime()
+			normStack.write(start-offset, norm)
+			if args.verbose<0:
+				masked = norm*weight
+				for j in range(len(norm)):
+					for d in (result.raw[j], norm[j], weight[j], masked[j]):
+						EMAN2.EMNumPy.numpy2em(d).write_image(args.debugFile, -1)
+			norm *= weight
+			maskedStack.write(start-offset, norm)
+			if args.savemask:
+				maskStack.putPacked(start-offset, result.labels)
+			if result.cacheFile and result.cached<len(norm):
+				maskCache.putPacked(start, result.labels)
+			if profiles is not None:
+				# the chunk level read and write times are shared evenly by the particles of the chunk
+				wall, cpu, rss = time.time()-t0, goldProfile.cpuTime()-c0, goldProfile.rssMB()
+				readTime = readTimes.pop((imageFile, start), None)
+				for p in profiles:
+					goldProfile.addStage(p, "write", wall/len(profiles), cpu/len(profiles), rss)
+					if readTime is not None: goldProfile.addStage(p, "read", readTime/len(profiles), 0, rss)
+				stackProfile.add(profiles)
+
+			nDone += len(norm)
+			nSkipped += result.skipped
+			nCached += result.cached
+			if checkpoint: checkpoint.update(start+len(norm)-offset, outputs)
+		except Exception, e:
+			if errors is None: raise
+			errors.append(e)
+		if slots: slots.release()
+	if prevFile: 
+		closeOutputs(*outputs)
+		# after an error the stack is incomplete: keep the last saved checkpoint to resume from and no manifest
+		if shard and not errors: writeShardManifest(prevFile, stacks[prevFile], args)
+		if checkpoint and not errors: checkpoint.save(stop-offset, [])
+		reportThroughput(prevFile, nDone, nSkipped, nCached, startTime, args)
+		if args.profile: writeProfile(stackProfile, imageBaseName, args)
+
+def imageFileList(args, stacks):
+	# yields the image files to process with the end of their particle range, and records their particle count, 
+	# particle range, first particle and checkpoint in stacks
 	for ifi, imageFile in enumerate(args.imageFiles):
-		nImage = EMAN2.EMUtil.get_image_count(imageFile)
+		stack = stackIO.openStack(imageFile)
+		nImage = len(stack)
 		if nImage<1: 
 			print "WARNING: 0 particles in image file %s" % (imageFile)
 			continue
-		imageBaseName = os.path.splitext(imageFile)[0]
-		normImageFile = "%s.norm.hdf" % (imageBaseName)
-		maskedImageFile = "%s.masked.hdf" % (imageBaseName)
+		shard = shardRange(nImage, args)
+		start, stop = shard or (0, nImage)
+		if start>=stop:
+			if args.verbose: print "Skip image file %d/%d: %s (no particles in %s of %d particles)" % (ifi+1, len(args.imageFiles), imageFile, shardName(args), nImage)
+			continue
+		first = start
+		checkpoint = None
+		if args.resume:
+			checkpoint = Checkpoint(imageFile, args, shard)
+			first = start+checkpoint.resumeIndex(stop-start)
+			if first>=stop:
+				if args.verbose: print "Skip image file %d/%d: %s (%d particles done by a previous run)" % (ifi+1, len(args.imageFiles), imageFile, stop-start)
+				continue
+		if shard and os.path.exists(shardManifestFile(imageFile, shard)):
+			os.remove(shardManifestFile(imageFile, shard))	# the shard is incomplete until this run finishes it
+		stacks[imageFile] = {"nImage":nImage, "shard":shard, "start":start, "stop":stop, "first":first, "checkpoint":checkpoint}
+		cacheFile = None
+		if args.cache:
+			# concurrent --shard jobs may create the directory at the same time
+			try:
+				os.makedirs(args.cache)
+			except OSError, e:
+				if e.errno!=errno.EEXIST or not os.path.isdir(args.cache): raise
+			# the cache file is created here, before the workers look for cached masks in it
+			key = segmentationKey(imageFile, args)
+			cacheFile = os.path.join(args.cache, "%s.goldmask" % (hashlib.sha1(key).hexdigest()))
+			cache = stackIO.MaskStack(cacheFile, nImage, stack.shape, key, mode="a")
+			if args.verbose: print "Gold mask cache %s: %d/%d particles" % (cacheFile, cache.count(), nImage)
+			cache.close()
+		yield ifi, imageFile, stop, cacheFile, first
+
+def outputBase(imageFile, shard=None):
+	# base name of the output files of an image file, or of the shard output files of its particles [start, stop)
+	imageBaseName = os.path.splitext(imageFile)[0]
+	if shard: imageBaseName += ".shard%d-%d" % shard
+	return imageBaseName
+
+def outputFiles(imageFile, args, shard=None):
+	imageBaseName = outputBase(imageFile, shard)
+	return ["%s.norm.%s" % (imageBaseName, args.outformat), "%s.masked.%s" % (imageBaseName, args.outformat)]
+
+def goldMaskFile(imageFile, shard=None):
+	return "%s.goldmask" % (outputBase(imageFile, shard))
+
+def goldMaskOutput(imageFile, nImage, shape, args, append=False, shard=None):
+	# the --savemask output: the binary gold masks of the particles bit-packed in a stackIO.MaskStack, one fixed size 
+	# record per particle for random access. a new file unless appending to a file of the same stack and options
+	key = dict((option, getattr(args, option)) for option in segmentationOptions)
+	key["input"] = os.path.basename(imageFile)
+	key = json.dumps(key, sort_keys=True)
+	if not append: stackIO.MaskStack.create(goldMaskFile(imageFile, shard), nImage, shape, key)
+	return stackIO.MaskStack(goldMaskFile(imageFile, shard), nImage, shape, key, mode="a")
+
+class Checkpoint(object):
+	# progress of one image file (or shard) for --resume: the particles [0, done) are in the output files.
+	# the results are written in particle order, so the done particles are always the first ones
+	def __init__(self, imageFile, args, shard=None):
+		self.imageFile = imageFile
+		self.filename = "%s.checkpoint.json" % (outputBase(imageFile, shard))
+		self.interval = args.checkpoint_interval
+		self.lastSave = time.time()
+		st = os.stat(imageFile)
+		options = dict((option, getattr(args, option)) for option in segmentationOptions+outputOptions)
+		outputs = outputFiles(imageFile, args, shard) + ([goldMaskFile(imageFile, shard)] if args.savemask else [])
+		self.state = {"input":{"size":st.st_size, "mtime":st.st_mtime}, "options":options, "outputs":outputs, "done":0}
+
+	def resumeIndex(self, nImage):
+		# first particle to process: after the particles done by the previous run if the input file, the options 
+		# and the output files are unchanged and the outputs can be read up to there. otherwise 0
+		try:
+			previous = json.load(open(self.filename))
+		except (IOError, ValueError):
+			return 0
+		if any(previous.get(k)!=self.state[k] for k in ["input", "options", "outputs"]):
+			return 0
+		done = min(previous.get("done", 0), nImage)
+		for output in self.state["outputs"]:
+			if not os.path.exists(output): return 0
+			try:
+				if output.endswith(".goldmask"):
+					if not stackIO.MaskStack(output).flags[:done].all(): return 0
+					continue
+				stack = stackIO.openStack(output)
+				if len(stack)<done: return 0
+				if done and not numpy.isfinite(stack.read(done-1, done)).all(): return 0
+			except Exception:
+				return 0
+		self.state["done"] = done
+		return done
+
+	def update(self, done, outputs):
+		if time.time()-self.lastSave>=self.interval: self.save(done, outputs)
+
+	def save(self, done, outputs):
+		# the outputs are flushed before the checkpoint claims that they contain the particles
+		for output in outputs: output.flush()
+		self.state["done"] = done
+		tmpFile = self.filename+".tmp"
+		with open(tmpFile, "w") as fp:
+			json.dump(self.state, fp, sort_keys=True)
+		os.rename(tmpFile, self.filename)
+		self.lastSave = time.time()
+
+# the options that change the gold segmentation. the normalization and --maskpad/--masksoft are not included
+segmentationOptions = ["solver", "solver_tol", "solver_autosize", "bin", "band", "bin_check", "bin_iou", "skip_nogold", "skip_size", "skip_minpixels"]
+# the other options that change the output files
+outputOptions = ["maskpad", "masksoft", "maskweight", "outformat", "savemask"]
+
+def segmentationKey(imageFile, args):
+	key = dict((option, getattr(args, option)) for option in segmentationOptions)
+	key["input"] = stackIO.fileHash(imageFile)
+	return json.dumps(key, sort_keys=True)
+
+# sharded runs: with --shard k/N or --range start:stop, a job only processes the particles [start, stop) of each image 
+# file, into its own <image>.shard<start>-<stop>.* output files, and lists them in a <image>.shard<start>-<stop>.json 
+# manifest once they are complete. the jobs only share the filesystem. --merge then checks that the complete shards of 
+# an image file cover all its particles once, with the same input and options, and assembles the output files of an 
+# unsharded run from them in the particle order
+
+def shardRange(nImage, args):
+	# the particles [start, stop) of an image file of nImage particles processed by this job. None without sharding
+	if args.shard:
+		k, n = args.shard
+		return (k*nImage//n, (k+1)*nImage//n)
+	if args.range:
+		start, stop = args.range
+		stop = nImage if stop is None else min(stop, nImage)
+		return (min(start, stop), stop)
+	return None
+
+def shardName(args):
+	if args.shard: return "shard %d/%d" % args.shard
+	return "range %d:%s" % (args.range[0], "" if args.range[1] is None else args.range[1])
+
+def shardManifestFile(imageFile, shard):
+	return "%s.json" % (outputBase(imageFile, shard))
+
+def writeShardManifest(imageFile, stack, args):
+	# written once the output files of the shard are closed, so that it only exists for complete shards
+	shard = stack["shard"]
+	st = os.stat(imageFile)
+	options = dict((option, getattr(args, option)) for option in segmentationOptions+outputOptions)
+	outputs = outputFiles(imageFile, args, shard) + ([goldMaskFile(imageFile, shard)] if args.savemask else [])
+	manifest = {"input":{"size":st.st_size, "mtime":st.st_mtime}, "particles":stack["nImage"], "range":list(shard),
+		"options":options, "outputs":[os.path.basename(output) for output in outputs]}
+	filename = shardManifestFile(imageFile, shard)
+	tmpFile = filename+".tmp"
+	with open(tmpFile, "w") as fp:
+		json.dump(manifest, fp, sort_keys=True)
+	os.rename(tmpFile, filename)
+
+def mergeMain(args):
+	# returns False if any image file could not be merged
+	merged = True
+	for ifi, imageFile in enumerate(args.imageFiles):
+		startTime = time.time()
+		nImage = stackIO.imageCount(imageFile)
+		manifests = shardManifests(imageFile)
+		shards, options, problems = checkShards(imageFile, nImage, manifests)
+		if problems:
+			print "ERROR: cannot merge the shards of image file %d/%d: %s (%d particles, %d shards)" % (ifi+1, len(args.imageFiles), imageFile, nImage, len(manifests))
+			for problem in problems: print "\t%s" % (problem)
+			merged = False
+			continue
+		outputs = mergeShards(imageFile, nImage, shards, manifests, options, args)
 		if args.verbose:
-			print "Start processing image file %d/%d: %s (%d particles)" % (ifi+1, len(args.imageFiles), imageFile, nImage)
-			if args.verbose<0:
-				args.debugFile = "%s.debug.hdf" % (imageBaseName)
+			print "Merged %d shards of image file %d/%d: %s (%d particles) in %.1f s into %s" % (len(shards), ifi+1, len(args.imageFiles), imageFile, nImage, time.time()-startTime, " ".join(outputs))
+	return merged
 
-		for i in range(nImage):
-			if args.verbose<0 or args.verbose>1:
-				print "Processing image file %d/%d: %s:%d" % (ifi+1, len(args.imageFiles), imageFile, i)
-		
-			d = EMAN2.EMData(imageFile, i)
-			if args.verbose<0:
-				d.write_image(args.debugFile, -1)
+def shardManifests(imageFile):
+	# {(start, stop): manifest} of the complete shards of an image file
+	directory, base = os.path.split(outputBase(imageFile))
+	pattern = re.compile(re.escape(base)+r"\.shard(\d+)-(\d+)\.json$")
+	manifests = {}
+	for name in os.listdir(directory or "."):
+		match = pattern.match(name)
+		if match:
+			manifests[(int(match.group(1)), int(match.group(2)))] = json.load(open(os.path.join(directory, name)))
+	return manifests
 
-			data = EMAN2.EMNumPy.em2numpy(d)
-			# scikit-image requires that float image pixel values are in range [-1, 1]
-			data = exposure.rescale_intensity(data, out_range=(-1, 1))
-			goldmask = findGoldMask(data, args.imageFiles)
-
-			nongoldpixels = data[numpy.where(goldmask==0)]
-			mean = numpy.mean(nongoldpixels)
-			sigma= numpy.std(nongoldpixels)
-			data = (data-mean)/sigma	# now non-gold region has mean=0 sigma=1
-			
-			dnorm = EMAN2.EMNumPy.numpy2em(data)
-			dnorm.write_image(normImageFile, i)
-			if args.verbose<0:
-				dnorm.write_image(args.debugFile, -1)
-			
-			dgm = EMAN2.EMNumPy.numpy2em(goldmask)
-			if(args.maskpad or args.masksoft):
-				dgm.process_inplace("mask.distance", {"pad":args.maskpad, "width":args.masksoft})
-			dgm = 1-dgm
-			dnorm *= dgm
-			
-			dnorm.write_image(maskedImageFile, i)
-			if args.verbose<0:
-				dgm.write_image(args.debugFile, -1)
-				dnorm.write_image(args.debugFile, -1)
+def checkShards(imageFile, nImage, manifests):
+	# the shards to merge in particle order, their options and the problems that prevent the merge
+	st = os.stat(imageFile)
+	directory = os.path.dirname(imageFile)
+	shards, options, problems = [], None, []
+	for shard in sorted(manifests):
+		manifest = manifests[shard]
+		name = os.path.basename(shardManifestFile(imageFile, shard))
+		if manifest.get("input")!={"size":st.st_size, "mtime":st.st_mtime} or manifest.get("particles")!=nImage:
+			problems.append("%s: made from another version of %s" % (name, imageFile))
+			continue
+		if options is None: options = manifest["options"]
+		if manifest["options"]!=options:
+			problems.append("%s: options %s differ from the options %s of the other shards" % (name, json.dumps(manifest["options"], sort_keys=True), json.dumps(options, sort_keys=True)))
+			continue
+		for output in manifest["outputs"]:
+			if not outputComplete(os.path.join(directory, output), shard[1]-shard[0]):
+				problems.append("%s: incomplete output file %s" % (name, output))
+		shards.append(shard)
 
-	EMAN2.E2end(logid)
+	done = 0
+	for start, stop in shards:
+		if start>done: problems.append("particles %d-%d: no shard" % (done, start-1))
+		if start<done: problems.append("particles %d-%d: in more than one shard (remove the extra .json manifests)" % (start, min(done, stop)-1))
+		done = max(done, stop)
+	if done<nImage: problems.append("particles %d-%d: no shard" % (done, nImage-1))
+	return shards, options, problems
 
-def findGoldMask(data, options):
-	data = denoise_tv_chambolle(data, weight=0.8, multichannel=False)
-	data = exposure.rescale_intensity(data, out_range=(-1, 1))
-	thresh = threshold_otsu(data)
-	sigma1 = numpy.std(data[ numpy.where(data<thresh) ])
-	sigma2 = numpy.std(data[ numpy.where(data>thresh) ])
-	markers = numpy.zeros(data.shape, dtype=numpy.uint)
-	markers[data < thresh-0.5*sigma1] = 1
-	markers[data > thresh+0.5*sigma2] = 2
-	labels = random_walker(data, markers, beta=10, mode='bf')
+def outputComplete(filename, n):
+	# the output file of a shard exists and holds its n particles
+	try:
+		if filename.endswith(".goldmask"):
+			masks = stackIO.MaskStack(filename)
+			return len(masks)==n and masks.count()==n
+		return stackIO.imageCount(filename)==n
+	except Exception:
+		return False
+
+def mergeShards(imageFile, nImage, shards, manifests, options, args):
+	# the output files of the image file assembled from the shard output files, with the options of the shards
+	directory = os.path.dirname(imageFile)
+	shardArgs = argparse.Namespace(**options)
+	outputs = outputFiles(imageFile, shardArgs) + ([goldMaskFile(imageFile)] if shardArgs.savemask else [])
+	for output in outputs:
+		if os.path.exists(output): os.remove(output)	# no particles of a previous run left at the end of the files
+	stacks = None
+	for start, stop in shards:
+		shardFiles = [os.path.join(directory, output) for output in manifests[(start, stop)]["outputs"]]
+		shardStacks = [stackIO.openStack(shardFile) for shardFile in shardFiles[:2]]
+		if stacks is None:
+			shape = shardStacks[0].shape
+			stacks = [stackIO.createStack(output, shape) for output in outputs[:2]]
+			if shardArgs.savemask: stacks.append(goldMaskOutput(imageFile, nImage, shape, shardArgs))
+		for i in range(0, stop-start, args.chunksize):
+			j = min(i+args.chunksize, stop-start)
+			for stack, shardStack in zip(stacks, shardStacks):
+				stack.write(start+i, shardStack.read(i, j))
+		if shardArgs.savemask:
+			stacks[2].putPacked(start, stackIO.MaskStack(shardFiles[2]).records)
+	closeOutputs(*stacks)
+	return outputs
+
+def writeProfile(stackProfile, imageBaseName, args):
+	summary = stackProfile.write(imageBaseName)
+	if args.verbose:
+		print "\tprofile written to %s.profile.json/.csv. time per stage (s):" % (imageBaseName)
+		for name, stage in sorted(summary["stages"].items(), key=lambda x: -x[1]["wall_total"]):
+			print "\t\t%-16s wall %10.3f  cpu %10.3f  p90 %8.4f" % (name, stage["wall_total"], stage["cpu_total"], stage["wall_p90"])
+
+def closeOutputs(*stacks):
+	for stack in stacks: stack.close()
+
+def reportThroughput(imageFile, nImage, nSkipped, nCached, startTime, args):
+	if args.verbose:
+		elapsed = max(time.time()-startTime, 1e-6)
+		print "Finished image file %s: %d particles in %.1f s (%.1f particles/s)" % (imageFile, nImage, elapsed, nImage/elapsed)
+		if args.skip_nogold:
+			print "\t%d/%d particles without gold were not segmented" % (nSkipped, nImage)
+		if args.cache:
+			print "\t%d/%d particles used cached gold masks" % (nCached, nImage)
+
+# per-process copy of the command line options, set by the pool initializer
+workerArgs = None
+# per-process cache of the open input stacks and gold mask caches
+workerStacks = {}
+workerMaskCaches = {}
+
+def initWorker(args):
+	global workerArgs
+	workerArgs = args
+
+def processChunk(task):
+	# segment and normalize a chunk of particles read in one block from the input stack (unless already read 
+	# by the reader thread). the results are returned as (n, ny, nx) numpy arrays so that they can be sent back 
+	# from the worker processes
+	ifi, imageFile, start, stop, chunk, cacheFile = task
+	args = workerArgs
+
+	readTime = None
+	if chunk is None:
+		t0, c0 = time.time(), goldProfile.cpuTime()
+		if imageFile not in workerStacks:
+			workerStacks.clear()
+			workerStacks[imageFile] = stackIO.openStack(imageFile)
+		chunk = workerStacks[imageFile].read(start, stop)
+		readTime = (time.time()-t0, goldProfile.cpuTime()-c0, goldProfile.rssMB())
+	result = ChunkResult(ifi, imageFile, start, cacheFile)
+	result.raw = numpy.array(chunk, copy=True) if args.verbose<0 else None
+
+	cachedMasks, cachedFlags = None, None
+	if cacheFile:
+		if cacheFile not in workerMaskCaches:
+			workerMaskCaches.clear()
+			workerMaskCaches[cacheFile] = stackIO.MaskStack(cacheFile)
+		cachedMasks, cachedFlags = workerMaskCaches[cacheFile].read(start, stop)
+	labels = numpy.empty(chunk.shape, dtype=numpy.uint8)
+
+	profiles = [None]*len(chunk)
+	if args.profile:
+		profiles = [goldProfile.newProfile(start+j) for j in range(len(chunk))]
+		for p in profiles:
+			if readTime: goldProfile.addStage(p, "read", readTime[0]/len(chunk), readTime[1]/len(chunk), readTime[2])
+		result.profiles = profiles
+
+	# rescale and pre-screen all particles first, so that the tv denoising of the particles segmented at full 
+	# resolution is done for the whole chunk at once
+	prepared = []
+	for j in range(len(chunk)):
+		goldProfile.current = profiles[j]
+		goldmask = cachedMasks[j] if cacheFile and cachedFlags[j] else None
+		data, skipped = prescreenParticle(chunk[j], args, goldmask is not None)
+		prepared.append((data, goldmask, skipped))
+	goldProfile.current = None
+	batch = [j for j, (data, goldmask, skipped) in enumerate(prepared) if goldmask is None and not skipped and not coarseToFine(data.shape, args)]
+	denoised = {}
+	if batch:
+		t0, c0 = time.time(), goldProfile.cpuTime()
+		denoised = dict(zip(batch, denoiseBatch(numpy.array([prepared[j][0] for j in batch]))))
+		if args.profile:
+			wall, cpu, rss = time.time()-t0, goldProfile.cpuTime()-c0, goldProfile.rssMB()
+			for j in batch: goldProfile.addStage(profiles[j], "tv_denoise", wall/len(batch), cpu/len(batch), rss)
+
+	for j in range(len(chunk)):
+		goldProfile.current = profiles[j]
+		data, goldmask, skipped = prepared[j]
+		chunk[j], skipped, labels[j] = segmentParticle(data, imageFile, start+j, args, goldmask, skipped, denoised.get(j))
+		result.skipped += skipped
+		result.cached += goldmask is not None
+	goldProfile.current = None
+
+	t0, c0 = time.time(), goldProfile.cpuTime()
+	weight = maskWeights(labels, args)
+	if args.profile:
+		wall, cpu, rss = time.time()-t0, goldProfile.cpuTime()-c0, goldProfile.rssMB()
+		for p in profiles: goldProfile.addStage(p, "mask_distance", wall/len(chunk), cpu/len(chunk), rss)
+
+	result.norm, result.weight = chunk, weight
+	if args.savemask or (cacheFile and result.cached<len(chunk)):
+		result.labels = stackIO.MaskStack.pack(labels)	# bit-packed for the transfer to the writer
+	return result
+
+class ChunkResult(object):
+	# what processChunk() sends back to the writer for a chunk of particles
+	def __init__(self, ifi, imageFile, start, cacheFile=None):
+		self.ifi = ifi
+		self.imageFile = imageFile
+		self.start = start
+		self.cacheFile = cacheFile
+		self.raw = None		# input images for the debug output
+		self.norm = None	# normalized images
+		self.weight = None	# 1-mask weights
+		self.labels = None	# bit-packed gold masks for --savemask and the cache
+		self.skipped = 0	# particles not segmented by the no-gold pre-screen
+		self.cached = 0		# particles with a cached gold mask
+		self.profiles = None
+
+def processParticle(data, imageFile, i, args, goldmask=None):
+	# returns the normalized image, the (1-mask) weight, if the segmentation was skipped and the gold mask.
+	# the segmentation is not done if the gold mask is given (cached)
+	data, skipped = prescreenParticle(data, args, goldmask is not None)
+	data, skipped, goldmask = segmentParticle(data, imageFile, i, args, goldmask, skipped)
+	with goldProfile.stage("mask_distance"):
+		weight = maskWeights(goldmask[numpy.newaxis], args)[0]
+	return data, weight, skipped, goldmask
+
+def prescreenParticle(data, args, cached=False):
+	# returns the rescaled image and if the segmentation is skipped by the no-gold pre-screen
+	from skimage import exposure
+
+	# scikit-image requires that float image pixel values are in range [-1, 1]
+	with goldProfile.stage("rescale"):
+		data = exposure.rescale_intensity(data, out_range=(-1, 1))
+	skipped = False
+	if not cached:
+		with goldProfile.stage("prescreen"):
+			skipped = args.skip_nogold and not hasGold(data, args)
+	return data, skipped
+
+def segmentParticle(data, imageFile, i, args, goldmask=None, skipped=False, denoised=None):
+	# processParticle() after the pre-screen, without the weight. denoised is the tv denoised image if already done 
+	# by denoiseBatch(). returns the normalized image, if the segmentation was skipped and the gold mask
+	cached = goldmask is not None
+	if cached:
+		goldmask = numpy.asarray(goldmask, dtype=numpy.int32)
+	elif skipped:
+		goldmask = numpy.zeros(data.shape, dtype=numpy.int32)
+	else:
+		goldmask = findGoldMask(data, args, denoised)
+	if not cached and not skipped and args.bin_check and i%args.bin_check==0 and coarseToFine(data.shape, args):
+		fullmask = findGoldMaskFull(data, args)
+		iou = maskIoU(goldmask, fullmask)
+		if iou<args.bin_iou:
+			print "WARNING: %s:%d binned segmentation differs from the full resolution segmentation (IoU=%.3f < %.3f). the full resolution mask is used" % (imageFile, i, iou, args.bin_iou)
+			goldmask = fullmask
+
+	with goldProfile.stage("statistics"):
+		data = normalizeNonGold(data, goldmask==0)
+
+	return data, int(skipped), goldmask
+
+def normalizeNonGold(data, nongold):
+	nongoldpixels = data[numpy.where(nongold)]
+	mean = numpy.mean(nongoldpixels)
+	sigma= numpy.std(nongoldpixels)
+	return (data-mean)/sigma	# now non-gold region has mean=0 sigma=1
+
+def maskWeights(goldmasks, args):
+	# (n, ny, nx) float32 (1-mask) weights of a chunk of gold masks: 0 on the gold and within --maskpad pixels of it,
+	# rising to 1 over the next --masksoft pixels (cosine edge, like mask.distance) and 1 in the rest of the image.
+	# without --maskpad and --masksoft (the defaults) the weights are 1-mask for both engines, which is all that
+	# maskWeight() computes then, without the EMData round trip. otherwise --maskweight eman2 (the default) uses
+	# mask.distance of EMAN2 particle by particle
+	goldmasks = numpy.asarray(goldmasks)
+	padded = args.maskpad or args.masksoft
+	if padded and getattr(args, "maskweight", "numpy") == "eman2":
+		return numpy.array([maskWeight(numpy.asarray(goldmask, dtype=numpy.int32), args) for goldmask in goldmasks], dtype=numpy.float32)
+	weights = numpy.ones(goldmasks.shape, dtype=numpy.float32)
+	n, ny, nx = goldmasks.shape
+	gold = numpy.flatnonzero(goldmasks.reshape(n, ny*nx).any(axis=1))
+	if not len(gold): return weights
+	if not padded:
+		weights[gold] = goldmasks[gold]==0
+		return weights
+	from scipy import ndimage
+	# the exact euclidean distance transform of each particle is only computed around its gold, up to the distance 
+	# where the weight reaches 1. one transform per particle is faster than one 3d transform of the chunk, whose 
+	# pass across the particles costs more than it saves. the distances are turned into the weights in place
+	reach = int(numpy.ceil(args.maskpad+args.masksoft))+1
+	for k in gold:
+		rows = numpy.flatnonzero(goldmasks[k].any(axis=1))
+		cols = numpy.flatnonzero(goldmasks[k].any(axis=0))
+		y0, y1 = max(rows[0]-reach, 0), min(rows[-1]+1+reach, ny)
+		x0, x1 = max(cols[0]-reach, 0), min(cols[-1]+1+reach, nx)
+		distance = ndimage.distance_transform_edt(goldmasks[k, y0:y1, x0:x1]==0)
+		distance -= args.maskpad
+		if args.masksoft:
+			distance /= args.masksoft
+			numpy.clip(distance, 0, 1, out=distance)
+			distance *= numpy.pi
+			numpy.cos(distance, out=distance)
+			distance *= -0.5
+			distance += 0.5
+			weights[k, y0:y1, x0:x1] = distance
+		else:
+			weights[k, y0:y1, x0:x1] = distance>0
+	return weights
+
+def maskWeight(goldmask, args):
+	# the weight of one particle with mask.distance of EMAN2
+	import EMAN2
+	dgm = EMAN2.EMNumPy.numpy2em(goldmask)
+	if(args.maskpad or args.masksoft):
+		dgm.process_inplace("mask.distance", {"pad":args.maskpad, "width":args.masksoft})
+	dgm = 1-dgm
+	return EMAN2.EMNumPy.em2numpy(dgm)	# 1 in non-gold region, 0 in gold region
+
+def hasGold(data, options):
+	# cheap pre-screen before the segmentation: after a light smoothing, gold shows up as a group of pixels
+	# far above the background (in robust sigma units, estimated from the median absolute deviation). noise does not
+	from scipy import ndimage
+	smoothed = ndimage.uniform_filter(data, size=getattr(options, "skip_size", 5))
+	median = numpy.median(smoothed)
+	sigma = 1.4826*numpy.median(numpy.abs(smoothed-median))
+	if sigma<=0: return True
+	nHigh = numpy.count_nonzero(smoothed > median+options.skip_nogold*sigma)
+	return nHigh >= getattr(options, "skip_minpixels", 10)
+
+def findGoldMask(data, options, denoised=None):
+	if coarseToFine(data.shape, options):
+		return findGoldMaskCoarseToFine(data, options)
+	return findGoldMaskFull(data, options, denoised)
+
+# smallest binned image of the coarse-to-fine segmentation. on the synthetic stacks of benchGold.py (markers of
+# 1/16 of the box), smaller binned images lost 0.05-0.5 of the IoU against the true masks and were not faster
+binMinSize = 128
+
+def coarseToFine(shape, options):
+	# if --bin applies to an image of this shape: smaller images are segmented at full resolution
+	binning = getattr(options, "bin", 1)
+	return binning>1 and min(shape)>=binning*binMinSize
+
+def findGoldMaskFull(data, options, denoised=None):
+	from skimage import exposure
+	from skimage.restoration import denoise_tv_chambolle
+	from skimage.filter import threshold_otsu
+	if denoised is not None:
+		data = denoised
+	else:
+		with goldProfile.stage("tv_denoise"):
+			data = denoise_tv_chambolle(data, weight=0.8, multichannel=False)
+			data = exposure.rescale_intensity(data, out_range=(-1, 1))
+	with goldProfile.stage("otsu"):
+		thresh = threshold_otsu(data)
+		sigma1 = numpy.std(data[ numpy.where(data<thresh) ])
+		sigma2 = numpy.std(data[ numpy.where(data>thresh) ])
+		markers = numpy.zeros(data.shape, dtype=numpy.uint)
+		markers[data < thresh-0.5*sigma1] = 1
+		markers[data > thresh+0.5*sigma2] = 2
+	labels = randomWalker(data, markers, options)
 	labels[labels != 2]=0
 	labels[labels == 2]=1
 	
 	return labels
 
-def parse_command_line():
+def findGoldMaskCoarseToFine(data, options):
+	# segment a binned copy first, then only re-segment the pixels within --band pixels
+	# of the upsampled gold boundary at full resolution. all other pixels keep the coarse label
+	from skimage import exposure
+	from skimage.restoration import denoise_tv_chambolle
+	from scipy import ndimage
+	binning = options.bin
+	band = getattr(options, "band", 4)
+	ny, nx = data.shape
+	by, bx = ny//binning*binning, nx//binning*binning
+	small = data[:by, :bx].reshape(by//binning, binning, bx//binning, binning).mean(axis=3).mean(axis=1)
+	small = exposure.rescale_intensity(small, out_range=(-1, 1))
+	coarse = findGoldMaskFull(small, options)
+
+	labels = numpy.zeros(data.shape, dtype=coarse.dtype)
+	labels[:by, :bx] = coarse.repeat(binning, axis=0).repeat(binning, axis=1)
+	if by<ny: labels[by:, :] = labels[by-1, :]
+	if bx<nx: labels[:, bx:] = labels[:, bx-1:bx]
+	if not labels.any() or labels.all(): return labels
+
+	distIn = ndimage.distance_transform_edt(labels)
+	distOut = ndimage.distance_transform_edt(labels==0)
+	bandmask = ((distIn>0) & (distIn<=band)) | ((distOut>0) & (distOut<=band))
+	# keep a seed in every coarse gold blob, including the blobs thinner than the band
+	components, nComponents = ndimage.label(labels)
+	for y, x in ndimage.maximum_position(distIn, components, range(1, nComponents+1)):
+		bandmask[y, x] = False
+
+	# the fine segmentation only needs the bounding box of the band plus a margin for the denoising
+	rows = numpy.nonzero(bandmask.any(axis=1))[0]
+	cols = numpy.nonzero(bandmask.any(axis=0))[0]
+	margin = band+binning
+	y0, y1 = max(rows[0]-margin, 0), min(rows[-1]+1+margin, ny)
+	x0, x1 = max(cols[0]-margin, 0), min(cols[-1]+1+margin, nx)
+
+	with goldProfile.stage("tv_denoise"):
+		crop = denoise_tv_chambolle(data[y0:y1, x0:x1], weight=0.8, multichannel=False)
+		crop = exposure.rescale_intensity(crop, out_range=(-1, 1))
+	markers = numpy.array(labels[y0:y1, x0:x1], dtype=numpy.uint)+1
+	markers[bandmask[y0:y1, x0:x1]] = 0
+	fine = randomWalker(crop, markers, options)
+	labels[y0:y1, x0:x1] = (fine==2)
+	
+	return labels
+
+def denoiseBatch(stack, weight=0.8, eps=2.e-4, n_iter_max=200, batchPixels=2**16):
+	# denoise_tv_chambolle(weight, multichannel=False) then rescale_intensity(out_range=(-1, 1)) of each image of 
+	# the (n, ny, nx) stack, with the Chambolle iterations run on batches of images at once instead of one call per 
+	# image. the batches are limited to batchPixels pixels: beyond that the working set of the iterations falls out 
+	# of the cpu cache and the batches are slower than the image by image calls
+	stack = numpy.asarray(stack)
+	if stack.dtype.kind != "f": stack = stack.astype(numpy.float64)
+	n, ny, nx = stack.shape
+	size = max(1, batchPixels//(ny*nx))
+	return numpy.concatenate([tvChambolleBatch(stack[start:start+size], weight, eps, n_iter_max) for start in range(0, n, size)])
+
+def tvChambolleBatch(image, weight, eps, n_iter_max):
+	# each image has its own energy and leaves the batch when it converges. the operations and their float types 
+	# follow skimage so that the results are identical to the image by image calls, the temporaries are reused
+	n, ny, nx = image.shape
+	out = numpy.empty_like(image)
+	active = numpy.arange(n)
+	p = numpy.zeros((2,)+image.shape, dtype=image.dtype)
+	g = numpy.zeros_like(p)
+	d = numpy.zeros_like(image)
+	current = numpy.array(image)
+	norm = numpy.empty_like(image)
+	tmp = numpy.empty_like(image)
+	tau = 1./4
+	for i in range(n_iter_max):
+		if i>0:
+			# d is the (negative) divergence of p
+			numpy.add(p[0], p[1], out=d)
+			numpy.negative(d, out=d)
+			d[:, 1:, :] += p[0, :, :-1, :]
+			d[:, :, 1:] += p[1, :, :, :-1]
+			numpy.add(image, d, out=current)
+		numpy.square(d, out=tmp)
+		E = tmp.reshape(len(tmp), -1).sum(axis=1).astype(numpy.float64)
+
+		# g holds the gradients of the images along y and x, norm their magnitude
+		numpy.subtract(current[:, 1:, :], current[:, :-1, :], out=g[0, :, :-1, :])
+		numpy.subtract(current[:, :, 1:], current[:, :, :-1], out=g[1, :, :, :-1])
+		numpy.square(g[0], out=norm)
+		numpy.square(g[1], out=tmp)
+		norm += tmp
+		numpy.sqrt(norm, out=norm)
+		E += weight*norm.reshape(len(norm), -1).sum(axis=1).astype(numpy.float64)
+		norm *= tau/weight
+		norm += 1.
+		g *= tau
+		p -= g
+		p /= norm
+		E /= float(ny*nx)
+		if i==0:
+			Einit = E
+			Eprevious = E
+			continue
+		done = numpy.abs(Eprevious-E) < eps*Einit
+		if done.all(): break
+		if done.any():
+			out[active[done]] = current[done]
+			keep = ~done
+			active, image, current, d, norm, tmp = active[keep], image[keep], current[keep], d[keep], norm[keep], tmp[keep]
+			p, g, Einit, E = p[:, keep], g[:, keep], Einit[keep], E[keep]
+		Eprevious = E
+	out[active] = current
+
+	# rescale_intensity(out_range=(-1, 1)) of each image, in place
+	imin = out.min(axis=2).min(axis=1)[:, numpy.newaxis, numpy.newaxis]
+	imax = out.max(axis=2).max(axis=1)[:, numpy.newaxis, numpy.newaxis]
+	out -= imin
+	out /= imax-imin
+	out *= 2
+	out += -1
+	return out
+
+# random walker solvers: 
+#   bf:    direct sparse LU solve. exact but time and memory grow quickly with the box size
+#   cg:    conjugate gradient without preconditioner
+#   cg_mg: conjugate gradient with algebraic multigrid preconditioner (requires pyamg)
+#   auto:  bf for boxes up to --solver_autosize pixels, cg_mg (or cg if pyamg is not available) for larger boxes
+solverChoices = ["auto", "bf", "cg", "cg_mg"]
+
+def randomWalker(data, markers, options):
+	from skimage.segmentation import random_walker
+	mode = chooseSolver(data.shape, options)
+	with goldProfile.stage("random_walker"):
+		if mode == "bf":
+			return random_walker(data, markers, beta=10, mode=mode)
+		return random_walker(data, markers, beta=10, mode=mode, tol=getattr(options, "solver_tol", 1e-3))
+
+def chooseSolver(shape, options):
+	solver = getattr(options, "solver", "bf")
+	if solver != "auto": return solver
+	if max(shape) <= getattr(options, "solver_autosize", 256): return "bf"
+	if pyamgAvailable(): return "cg_mg"
+	return "cg"
+
+def pyamgAvailable():
+	try:
+		import pyamg
+		return True
+	except ImportError:
+		return False
+
+def maskIoU(mask1, mask2):
+	# intersection over union of two binary masks. 1 if both masks are empty
+	mask1 = numpy.asarray(mask1)>0
+	mask2 = numpy.asarray(mask2)>0
+	union = numpy.count_nonzero(mask1 | mask2)
+	if union==0: return 1.0
+	return numpy.count_nonzero(mask1 & mask2)/float(union)
+
+# whole-micrograph mode: the gold is segmented once per micrograph instead of once per boxed particle. with overlapping
+# boxes the same gold is then denoised and random-walked only once, and gold blobs cut by the box edges are segmented
+# whole. the otsu markers and the random walker split the noise of large regions where gold is only a tiny fraction of
+# the pixels, so the micrograph is not segmented as a whole: the gold candidates are pre-screened like hasGold() on the
+# whole micrograph and only box sized windows around them are segmented, as in the per-particle mode. the particles,
+# their non-gold statistics and their masks are cut out of the micrograph and its gold mask with the boxes of the
+# <micrograph>.box file
+
+def micrographMain(args):
+	if args.processes>1:
+		pool = multiprocessing.Pool(args.processes, initWorker, (args,))
+		imap = pool.imap
+	else:
+		pool = None
+		initWorker(args)
+		imap = itertools.imap
+
+	for ifi, micrographFile in enumerate(args.imageFiles):
+		startTime = time.time()
+		boxFile = os.path.splitext(micrographFile)[0]+args.boxext
+		if not os.path.exists(boxFile):
+			print "WARNING: no box file %s for micrograph %s" % (boxFile, micrographFile)
+			continue
+		boxes = readBoxes(boxFile)
+		if not boxes:
+			print "WARNING: 0 boxes in box file %s" % (boxFile)
+			continue
+		if len(set((w, h) for x0, y0, w, h in boxes))>1:
+			print "ERROR: boxes of different sizes in box file %s" % (boxFile)
+			sys.exit(-1)
+
+		micrograph = stackIO.openStack(micrographFile).read(0, 1)[0]
+		h, w = boxes[0][3], boxes[0][2]
+		if args.verbose:
+			print "Start processing micrograph %d/%d: %s (%d x %d, %d boxes)" % (ifi+1, len(args.imageFiles), micrographFile, micrograph.shape[1], micrograph.shape[0], len(boxes))
+		goldmask, nWindows = micrographGoldMask(micrograph, args.tile or max(h, w), args, imap)
+		if args.verbose>1:
+			print "\t%d gold windows segmented" % (nWindows)
+
+		normStack = stackIO.createStack(outputFiles(micrographFile, args)[0], (h, w))
+		maskedStack = stackIO.createStack(outputFiles(micrographFile, args)[1], (h, w))
+		outputs = [normStack, maskedStack]
+		if args.savemask:
+			maskStack = goldMaskOutput(micrographFile, len(boxes), (h, w), args)
+			outputs.append(maskStack)
+		for start in range(0, len(boxes), args.chunksize):
+			norm, weight, masks = cutParticles(micrograph, goldmask, boxes[start:start+args.chunksize], args)
+			normStack.write(start, norm)
+			norm *= weight
+			maskedStack.write(start, norm)
+			if args.savemask: maskStack.put(start, masks)
+		closeOutputs(*outputs)
+
+		if args.verbose:
+			elapsed = max(time.time()-startTime, 1e-6)
+			print "Finished micrograph %s: %d particles in %.1f s (%.1f particles/s), %.2f%% gold pixels" % (micrographFile, len(boxes), elapsed, len(boxes)/elapsed, 100.*numpy.count_nonzero(goldmask)/goldmask.size)
+
+	if pool:
+		pool.close()
+		pool.join()
+
+def readBoxes(boxFile):
+	# EMAN .box file: x0 y0 width height of one box per line, (x0, y0) being the first column and row of the box
+	boxes = []
+	for line in open(boxFile):
+		fields = line.split()
+		if len(fields)<4 or line.startswith("#"): continue
+		boxes.append([int(round(float(v))) for v in fields[:4]])
+	return boxes
+
+def micrographGoldMask(micrograph, size, args, imap):
+	# the gold mask of the micrograph, segmented in the windows around the gold candidates, and the number of windows
+	from skimage import exposure
+	data = exposure.rescale_intensity(numpy.asarray(micrograph, dtype=numpy.float64), out_range=(-1, 1))
+	candidates = goldCandidates(data, args)
+	windows = candidateWindows(candidates, size, args.tile_overlap, max(args.tile_max or 2*size, size))
+	goldmask = numpy.zeros(data.shape, dtype=numpy.uint8)
+	tasks = ((data[y0:y1, x0:x1], candidates[y0:y1, x0:x1]) for y0, y1, x0, x1 in windows)
+	for (y0, y1, x0, x1), labels in itertools.izip(windows, imap(segmentWindow, tasks)):
+		goldmask[y0:y1, x0:x1] |= labels
+	return goldmask, len(windows)
+
+def goldCandidates(data, args):
+	# the groups of at least --skip_minpixels pixels that are --skip_nogold (5 if 0) robust sigmas above the median
+	# after the --skip_size smoothing of hasGold(), with the median and sigma of the whole micrograph
+	from scipy import ndimage
+	smoothed = ndimage.uniform_filter(data, size=args.skip_size)
+	median = numpy.median(smoothed)
+	sigma = 1.4826*numpy.median(numpy.abs(smoothed-median))
+	high = smoothed > median+(args.skip_nogold or 5)*sigma
+	components, nComponents = ndimage.label(high)
+	if not nComponents: return high
+	sizes = numpy.bincount(components.ravel())
+	sizes[0] = 0
+	return (sizes>=args.skip_minpixels)[components]
+
+def candidateWindows(candidates, size, margin, maxSize):
+	# [(y0, y1, x0, x1)] windows segmented around the candidates: the bounding box of the candidates closer than
+	# 2*margin to each other plus margin on each side, grown to at least size x size and kept inside the micrograph.
+	# a box larger than maxSize (a dense gold field merges into one box) is split into maxSize tiles overlapping by
+	# 2*margin, and only the tiles with candidates of the group are kept
+	from scipy import ndimage
+	grown = ndimage.maximum_filter(candidates, size=2*margin+1)
+	groups = ndimage.label(grown)[0]
+	ny, nx = candidates.shape
+	windows = []
+	for k, (rows, cols) in enumerate(ndimage.find_objects(groups)):
+		for y0, y1 in splitRange(*growRange(rows.start, rows.stop, size, ny), maxSize=maxSize, overlap=2*margin):
+			for x0, x1 in splitRange(*growRange(cols.start, cols.stop, size, nx), maxSize=maxSize, overlap=2*margin):
+				if (candidates[y0:y1, x0:x1] & (groups[y0:y1, x0:x1]==k+1)).any():
+					windows.append((y0, y1, x0, x1))
+	return windows
+
+def growRange(start, stop, size, n):
+	# [start, stop) grown around its center to at least size, inside [0, n)
+	if stop-start<size:
+		start = max(min((start+stop)//2-size//2, n-size), 0)
+		stop = min(start+size, n)
+	return start, stop
+
+def splitRange(start, stop, maxSize, overlap):
+	# [start, stop) split into evenly spaced ranges of maxSize overlapping by at least overlap, if longer than maxSize
+	if stop-start<=maxSize: return [(start, stop)]
+	step = max(maxSize-overlap, maxSize//2)
+	n = -(-(stop-start-maxSize)//step)+1
+	return [(y0, y0+maxSize) for y0 in numpy.linspace(start, stop-maxSize, n).round().astype(int)]
+
+def segmentWindow(task):
+	# the gold mask of a window rescaled like a boxed particle. only the gold blobs that contain a candidate are kept
+	from skimage import exposure
+	from scipy import ndimage
+	data, candidates = task
+	data = exposure.rescale_intensity(data, out_range=(-1, 1))
+	components, nComponents = ndimage.label(findGoldMask(data, workerArgs))
+	keep = numpy.zeros(nComponents+1, dtype=numpy.uint8)
+	keep[components[candidates]] = 1
+	keep[0] = 0
+	return keep[components]
+
+def cutParticles(micrograph, goldmask, boxes, args):
+	# the normalized particles, their (1-mask) weights and gold masks. the pixels of the boxes outside of the 
+	# micrograph are not used for the statistics and are 0 in the normalized particles
+	h, w = boxes[0][3], boxes[0][2]
+	norm = numpy.empty((len(boxes), h, w), dtype=numpy.float32)
+	masks = numpy.empty((len(boxes), h, w), dtype=numpy.uint8)
+	for j, (x0, y0) in enumerate(box[:2] for box in boxes):
+		data, inside = cutBox(micrograph, x0, y0, w, h)
+		mask, inside = cutBox(goldmask, x0, y0, w, h)
+		data = normalizeNonGold(data, (mask==0) & inside)
+		data[~inside] = 0
+		norm[j] = data
+		masks[j] = mask
+	return norm, maskWeights(masks, args), masks
+
+def cutBox(image, x0, y0, w, h):
+	# the h x w box of the image at (x0, y0), zero filled outside of the image, and where the box is inside the image
+	box = numpy.zeros((h, w), dtype=image.dtype)
+	inside = numpy.zeros((h, w), dtype=bool)
+	ny, nx = image.shape
+	by0, by1, bx0, bx1 = max(y0, 0), min(y0+h, ny), max(x0, 0), min(x0+w, nx)
+	if by0<by1 and bx0<bx1:
+		box[by0-y0:by1-y0, bx0-x0:bx1-x0] = image[by0:by1, bx0:bx1]
+		inside[by0-y0:by1-y0, bx0-x0:bx1-x0] = True
+	return box, inside
+
+def parse_command_line(argv=None):
 	description = "mask gold particle and normalize image using non-gold region"
 	epilog  = "Author: Wen Jiang (jiang12@purdue.edu)\n"
 	epilog += "Copyright (c) 2014 Purdue University\n"
@@ -92,19 +1027,102 @@ def parse_command_line():
 		
 	parser.add_argument("--maskpad", metavar="<n>", type=float, help="pad the mask by this number of pixels. default to 0", default=0)
 
-	parser.add_argument("--masksoft", metavar="<n>", type=float, help="use soft mask with this half width. default to 0", default=0)
+	parser.add_argument("--masksoft", metavar="<n>", type=float, help="use soft mask with an edge of this width: the mask falls from 1 at --maskpad pixels from the gold to 0 at --maskpad+--masksoft pixels (the width of mask.distance). default to 0", default=0)
+
+	parser.add_argument("--maskweight", metavar="<numpy|eman2>", choices=["numpy", "eman2"], help="computation of the --maskpad/--masksoft mask: eman2, mask.distance particle by particle, or numpy, a euclidean distance transform of whole chunks of masks with a cosine edge. numpy is faster but stays opt-in until benchGold.py --maskweights passes against a real EMAN2, which has not been run yet. without --maskpad and --masksoft neither engine is used. default to eman2", default="eman2")
+
+	parser.add_argument("--solver", metavar="<%s>" % ("|".join(solverChoices)), choices=solverChoices, help="random walker solver. default to bf", default="bf")
+
+	parser.add_argument("--solver_tol", metavar="<x>", type=float, help="convergence tolerance of the iterative (cg, cg_mg) solvers. default to 1e-3", default=1e-3)
+
+	parser.add_argument("--solver_autosize", metavar="<n>", type=int, help="largest box size solved with bf when --solver=auto. default to 256", default=256)
+
+	parser.add_argument("--bin", metavar="<n>", type=int, choices=[1, 2, 4], help="segment a n x n binned image first and refine only around the gold boundary at full resolution (1, 2, 4). only applies to particles of at least 128*n pixels, smaller ones are segmented at full resolution. on synthetic stacks (benchGold.py --synthetic --bins) --bin 2 is 1.4-2x faster at 256 pixels and 2.5-2.9x at 512, for a loss of 0.01 of the IoU against the true masks of round markers (0.03-0.07 for triangles), --bin 4 is 3.6-4.4x faster at 512 pixels for a loss of 0.01 (0.05 for triangles). default to 1", default=1)
+
+	parser.add_argument("--band", metavar="<n>", type=int, help="half width in pixels of the band around the binned gold boundary that is re-segmented at full resolution. default to 4", default=4)
+
+	parser.add_argument("--bin_check", metavar="<n>", type=int, help="with --bin, also segment every n-th particle at full resolution and use that mask if the IoU is below --bin_iou. default to 0 (no check)", default=0)
+
+	parser.add_argument("--bin_iou", metavar="<x>", type=float, help="minimal IoU between the binned and the full resolution masks accepted by --bin_check. default to 0.9", default=0.9)
+
+	parser.add_argument("--skip_nogold", metavar="<x>", type=float, help="do not segment particles without any smoothed pixel this many robust sigmas above the median (no gold). 0 to segment all particles. default to 0", default=0)
+
+	parser.add_argument("--skip_size", metavar="<n>", type=int, help="size of the smoothing box used by --skip_nogold. default to 5", default=5)
+
+	parser.add_argument("--skip_minpixels", metavar="<n>", type=int, help="minimal number of pixels above the --skip_nogold threshold for a particle to be segmented. default to 10", default=10)
+
+	parser.add_argument("--processes", "--threads", metavar="<n>", type=int, help="number of worker processes used to process the particles in parallel. default to 1", default=1)
+
+	parser.add_argument("--chunksize", metavar="<n>", type=int, help="number of particles read, processed by a worker process and written at a time. default to 16", default=16)
+
+	parser.add_argument("--prefetch", metavar="<n>", type=int, help="pipeline mode: read up to n chunks ahead in a reader thread and write the results in a writer thread, overlapping the disk I/O with the computation. default to 0 (no pipeline)", default=0)
+
+	parser.add_argument("--outformat", metavar="<hdf|mrcs>", choices=["hdf", "mrcs"], help="file format of the .norm and .masked output files. mrcs files are written in blocks through one open file, hdf files one image at a time through EMAN2. default to mrcs", default="mrcs")
+
+	parser.add_argument("--savemask", action="store_true", help="also write the binary gold masks to <imageFile>.goldmask: bit-packed with one fixed size record per particle, 1/32 of the size of float32 images. read them with stackIO.MaskStack(filename).get(i) or .read(start, stop)", default=False)
+
+	parser.add_argument("--resume", action="store_true", help="record the progress of each image file in <imageFile>.checkpoint.json and continue an interrupted run from there. finished image files with unchanged inputs and options are skipped", default=False)
+
+	parser.add_argument("--checkpoint_interval", metavar="<s>", type=float, help="seconds between checkpoint updates with --resume. default to 30", default=30)
+
+	parser.add_argument("--cache", metavar="<dir>", help="keep the gold masks in bit-packed files in this directory, keyed by the input file content and the segmentation options. reruns with other --maskpad/--masksoft reuse them instead of segmenting again", default=None)
+
+	parser.add_argument("--profile", action="store_true", help="record the wall time, cpu time and memory (resident at the end of the stage and peak of the process) of each processing stage of each particle and write <imageFile>.profile.json/.csv summaries", default=False)
+
+	parser.add_argument("--shard", metavar="<k/N>", type=shardArgument, help="process only the k-th of N consecutive slices of the particles of each image file (k from 0 to N-1, e.g. the index of a cluster array job) into <imageFile>.shard<start>-<stop>.* files, listed in a <imageFile>.shard<start>-<stop>.json manifest once complete. assemble the shards with --merge", default=None)
+
+	parser.add_argument("--range", metavar="<start:stop>", type=rangeArgument, help="like --shard, for the particles [start, stop) of each image file (start: for all particles from start), e.g. to split a failed shard", default=None)
+
+	parser.add_argument("--merge", action="store_true", help="assemble the .norm and .masked (and .goldmask) files of each image file from the outputs of its --shard/--range jobs, in particle order. fails if the complete shards do not cover all particles exactly once with the same input and options", default=False)
+
+	parser.add_argument("--micrograph", action="store_true", help="the input files are micrographs: segment the gold once per micrograph, in windows around the gold candidates (the --skip_nogold pre-screen of the whole micrograph, 5 robust sigmas if --skip_nogold is 0), and cut the particles and their masks out of the micrograph with the boxes of <micrograph>.box (see --boxext). writes <micrograph>.norm/.masked particle stacks. benchGold.py --micrograph compares the masks with those of the boxes segmented one by one", default=False)
+
+	parser.add_argument("--boxext", metavar="<ext>", help="extension of the EMAN box files (x0 y0 width height per line) replacing the micrograph extension with --micrograph. default to .box", default=".box")
+
+	parser.add_argument("--tile", metavar="<n>", type=int, help="minimal size of the windows segmented around the gold candidates with --micrograph. windows much larger than the gold make the segmentation split the noise. default to 0 (the box size)", default=0)
+
+	parser.add_argument("--tile_overlap", metavar="<n>", type=int, help="margin in pixels around the gold candidates in the windows segmented with --micrograph. candidates closer than twice the margin share a window. default to 16", default=16)
+
+	parser.add_argument("--tile_max", metavar="<n>", type=int, help="maximal size of the windows segmented with --micrograph: a larger window of merged candidates (a dense gold field) is split into overlapping tiles of this size. default to 0 (twice --tile)", default=0)
 
 	parser.add_argument("--verbose", metavar="<n>", type=int, help="verbose level (0, 1, 2). default to 1", default=1)
 	
-	args=parser.parse_args()
+	args=parser.parse_args(argv)
 
 	if len(args.imageFiles)<1: 
 		print "At least one inumpyut image is required"
 		parser.print_help()
 		sys.exit(-1)
+	if args.micrograph and (args.resume or args.cache or args.prefetch or args.profile or args.shard or args.range or args.merge):
+		parser.error("--resume, --cache, --prefetch, --profile, --shard, --range and --merge are not supported with --micrograph")
+	if args.shard and args.range:
+		parser.error("--shard and --range are exclusive")
+	if args.merge and (args.shard or args.range or args.resume):
+		parser.error("--shard, --range and --resume are not supported with --merge")
 	
 	return args
 
+def shardArgument(value):
+	# "k/N" -> (k, N)
+	try:
+		k, n = [int(v) for v in value.split("/")]
+	except ValueError:
+		raise argparse.ArgumentTypeError("%s is not k/N" % (value))
+	if not 0<=k<n:
+		raise argparse.ArgumentTypeError("k must be from 0 to N-1 in --shard k/N, not %s" % (value))
+	return k, n
+
+def rangeArgument(value):
+	# "start:stop" or "start:" -> (start, stop or None)
+	try:
+		start, stop = value.split(":")
+		start, stop = int(start), int(stop) if stop.strip() else None
+	except ValueError:
+		raise argparse.ArgumentTypeError("%s is not start:stop" % (value))
+	if start<0 or (stop is not None and stop<=start):
+		raise argparse.ArgumentTypeError("--range start:stop requires 0 <= start < stop, not %s" % (value))
+	return start, stop
+
 
 if __name__== "__main__":
 	main()
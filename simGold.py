@@ -34,9 +34,9 @@
 from EMAN2 import *
 import numpy as np
 import os, sys, math
-from skimage.draw import (polygon, ellipse)
-from skimage.morphology import (diamond, octagon, square, rectangle, star)
-import random
+import random, zlib, itertools, multiprocessing
+import stackIO
+import goldAPI
 
 def main():
 	progname = os.path.basename(sys.argv[0])
@@ -48,6 +48,9 @@ def main():
         --triangle_side 70 --rect_width 50 --rect_height 10 --square_width 30 --diamond_radius 30 --octagon_m 10 --octagon_n 10
         --star_size 20 --ellipse_yradius 20 --ellipse_xradius 30 --circle_radius 40 --ptcl_radius 40 --marker_pixel 20
 	--marker_pixel_offset 2 --centerShift 4 --verbose 10
+        Rotated, size jittered and multiple markers per particle:
+        python simGold.py --imagefile ptcl_stack.hdf --shape triangle --triangle_side 40 --ptcl_radius 40 --marker_pixel 20
+        --centerShift 30 --rotate 180 --size_jitter 0.2 --markers 3
         """
                 
 	parser = EMArgumentParser(usage=usage,version=EMANVERSION)
@@ -91,14 +94,31 @@ def main():
         #if shape is circle
         parser.add_argument('--circle_radius', type=float, metavar="<n>", dest="circle_radius", help='The radius of circle.')
 	
+	parser.add_argument("--chunksize", type=int, metavar="<n>", dest="chunksize", default=256, \
+			    help="Number of particles read, processed and written at a time.")
+	parser.add_argument("--normalize", type=str, metavar="<numpy|eman2>", dest="normalize", default="eman2", choices=["numpy", "eman2"], \
+			    help="Normalization of the particles: the EMAN2 normalize.mask.circlemean processor, one particle at a time, or numpy, a batched version of it: the mean within the hard circle of --ptcl_radius and the sigma of the whole particle. numpy is faster but stays opt-in until benchGold.py --circlemean passes against a real EMAN2.")
+	parser.add_argument("--seed", type=int, metavar="<n>", dest="seed", default=None, \
+			    help="Seed of the per particle shifts and marker pixels. The same seed gives the same output stacks for any --chunksize and --processes. A random seed is used and printed if not set.")
+	parser.add_argument("--processes", type=int, metavar="<n>", dest="processes", default=1, \
+			    help="Number of processes reading and normalizing the particles.")
 	parser.add_argument("--centerShift", type=int, dest="centerShift", default=0, \
 			    help="A range to shift the simulated gold from the center, 2 random numbers will be generated randomly in this range for shift in x and y direction. \
 			    E.g. the particles will be shifted fro center in the range of [-4, 4] if set --centerShift 4 ")
+	parser.add_argument("--rotate", type=float, metavar="<deg>", dest="rotate", default=0, \
+			    help="Rotate each simulated gold marker by a random angle in [-rotate, rotate] degrees, 180 for any in-plane orientation.")
+	parser.add_argument("--markers", type=int, metavar="<n>", dest="markers", default=1, \
+			    help="Number of simulated gold markers per particle, each at its own random shift in the --centerShift range.")
+	parser.add_argument("--size_jitter", type=float, metavar="<x>", dest="size_jitter", default=0, \
+			    help="Scale each simulated gold marker by a random factor in [1 - size_jitter, 1 + size_jitter].")
 	
         parser.add_argument("--verbose", "-v", dest="verbose", action="store", metavar="n", type=int, default=0, help="verbose level, higner number means higher level of verboseness")
         parser.add_argument('--ppid', type=int, help="Set the PID of the parent process, used for cross platform PPID",default=-1)
         
         (options, args) = parser.parse_args()
+	if (options.markers < 1 or not 0 <= options.size_jitter < 1):
+	    print "ERROR: --markers must be at least 1 and --size_jitter in [0, 1)"
+	    sys.exit()
 	logger = E2init(sys.argv, options.ppid)
         
         imagefile=options.imagefile
@@ -135,6 +155,9 @@ def main():
         shapeList = (options.shape).split(",")
         print shapeList
         
+        # all requested shapes are simulated in a single pass over the particles
+        masks = []
+        
         
         if ('triangle' in shapeList):
             print "The shape of gold is triangle."
@@ -146,7 +169,7 @@ def main():
                 if (options.verbose >= 10):
                     goldMask.write_image('triMask.hdf')
                 outfile = imagefile[0:temp]+'_simTriangle.hdf'
-                applyMask(imagefile, goldMask, outfile, options) 
+                masks.append(('triangle', goldMask, outfile))
         '''    
         if ('rectangle' in shapeList):
             print "The shape of gold is rectangle."
@@ -170,7 +193,7 @@ def main():
                 if (options.verbose >= 10):
                     goldMask.write_image('rectMask.hdf')
                 outfile = imagefile[0:temp]+'_simRectangle.hdf'
-                applyMask(imagefile, goldMask, outfile, options) 
+                masks.append(('rectangle', goldMask, outfile))
 	
 	
 	
@@ -197,7 +220,7 @@ def main():
                 if (options.verbose >= 10):
                     goldMask.write_image('squareMask.hdf')
                 outfile = imagefile[0:temp]+'_simSquare.hdf'
-                applyMask(imagefile, goldMask, outfile, options)
+                masks.append(('square', goldMask, outfile))
 	
 	
 	
@@ -211,7 +234,7 @@ def main():
                 if (options.verbose >= 10):
                     goldMask.write_image('diamondMask.hdf')
                 outfile = imagefile[0:temp]+'_simDiamond.hdf'
-                applyMask(imagefile, goldMask, outfile, options)
+                masks.append(('diamond', goldMask, outfile))
             
         if ('octagon' in shapeList):
             print "The shape of gold is octagon."
@@ -223,7 +246,7 @@ def main():
                 if (options.verbose >= 10):
                     goldMask.write_image('octMask.hdf')
                 outfile = imagefile[0:temp]+'_simOctagon.hdf'
-                applyMask(imagefile, goldMask, outfile, options)
+                masks.append(('octagon', goldMask, outfile))
             
         if ('star' in shapeList):
             print "The shape of gold is star."
@@ -235,7 +258,7 @@ def main():
                 if (options.verbose >= 10):
                     goldMask.write_image('starMask.hdf')
                 outfile = imagefile[0:temp]+'_simStar.hdf'
-                applyMask(imagefile, goldMask, outfile, options)
+                masks.append(('star', goldMask, outfile))
             
         if ('ellipse' in shapeList):
             print "The shape of gold is ellipse."
@@ -247,7 +270,7 @@ def main():
                 if (options.verbose >= 10):
                     goldMask.write_image('ellipseMask.hdf')
                 outfile = imagefile[0:temp]+'_simEllipse.hdf'
-                applyMask(imagefile, goldMask, outfile, options)
+                masks.append(('ellipse', goldMask, outfile))
             
         if ('circle' in shapeList):
             print "The shape of gold is circle."
@@ -259,68 +282,251 @@ def main():
                 if (options.verbose >= 10):
                     goldMask.write_image('circleMask.hdf')
                 outfile = imagefile[0:temp]+'_simCircle.hdf'
-                applyMask(imagefile, goldMask, outfile, options)
+                masks.append(('circle', goldMask, outfile))
             
         if (not shapeList):
             print "You have to provide a shape of simulated markers by --shape <shape>."
             sys.exit()
+        
+        if (masks):
+            applyMasks(imagefile, masks, options)
 
 
-def applyMask(imagefile, goldMask, outfile, options):
-    n=EMUtil.get_image_count(imagefile)
-    d=EMData()
-    d.read_image(imagefile, 0, True)
-    boxsize=d["nx"]
-    img=EMData(boxsize,boxsize)
-    ptcl_radius=options.ptcl_radius
-    marker_pixel=options.marker_pixel
-    m=marker_pixel
-    ############################ Do we need to put this inside the for loop?
-    offset = options.marker_pixel_offset
-    marker_pixel=random.uniform(m-offset,m+offset)
-    
-    #marker_pixel=random.uniform(m,m+2)
-    #print marker_pixel
-    goldMask.mult(marker_pixel)
-    
-    #############################
-    if (options.centerShift):
-	start = options.centerShift * (-1)
-	end = options.centerShift
+def applyMask(imagefile, goldMask, outfile, options, shape='marker'):
+    applyMasks(imagefile, [(shape, goldMask, outfile)], options)
+
+
+def applyMasks(imagefile, masks, options):
+    # masks is a list of (shape, goldMask, outfile). the particles are read and normalized once, in chunks,
+    # then written with each of the gold masks added to the corresponding output file. the shift and the
+    # marker pixel of a particle only depend on (seed, shape, particle index), so the output stacks are the
+    # same for any chunk size and number of processes
+    stack = stackIO.openStack(imagefile)
+    n = len(stack)
+    boxsize = stack.shape[1]
+    seed = options.seed
+    if seed is None:
+        seed = random.randint(0, 2**31-1)
+        print "random seed: %d" % (seed)
+    markers = []
+    for shape, goldMask, outfile in masks:
+        if(boxsize != goldMask.get_xsize()):
+            print "ERROR: the size of simulated gold mask != the boxsize of real particles!"
+            sys.exit()
+        if (options.rotate or options.markers > 1 or options.size_jitter):
+            if (options.centerShift >= boxsize//2):
+                print "ERROR: centerShift must be smaller than half the boxsize of particles with --rotate, --markers or --size_jitter!"
+                sys.exit()
+            sizes = [getattr(options, name) for name in shapeOptions[shape]]
+            markers.append((shape, MarkerRaster(shape, sizes, boxsize, seed, options)))
+        else:
+            markers.append((shape, MarkerROI(EMNumPy.em2numpy(goldMask), options.centerShift)))
+    
+    outputs = [stackIO.createStack(outfile, (boxsize, boxsize)) for shape, goldMask, outfile in masks]
+    chunks = [(first, min(first+options.chunksize, n)) for first in range(0, n, options.chunksize)]
+    pool = None
+    if (options.processes > 1):
+        pool = multiprocessing.Pool(options.processes, initializer=initWorker, initargs=(imagefile, options.ptcl_radius, options.normalize))
+        normalized = pool.imap(normalizeChunk, chunks)
     else:
-	start = 0
-	end = 0	
-    #print start, end
-    #a, b = random.randint(start, end), random.randint(start, end)
-    #this random number is needed to generate inside the for loop
-    #a=random.randint(-4,4)
-    #b=random.randint(-4,4)
-    #goldMask.process_inplace('xform.translate.int', {'trans':(a, b)})
-    #goldMask.write_image("goldMask.hdf")
-
-    if(boxsize != goldMask.get_xsize()):
-        print "ERROR: the size of simulated gold mask != the boxsize of real particles!"
+        initWorker(imagefile, options.ptcl_radius, options.normalize)
+        normalized = itertools.imap(normalizeChunk, chunks)
+    
+    for (first, last), chunk in itertools.izip(chunks, normalized):
+        index = np.arange(first, last)
+        for (shape, marker), output in zip(markers, outputs):
+            shifts = particleShifts(seed, shape, index, options.centerShift)
+            pixels = particleMarkerPixels(seed, shape, index, options.marker_pixel, options.marker_pixel_offset)
+            marker.write(output, first, chunk, shifts, pixels)
+    
+    if pool:
+        pool.close()
+        pool.join()
+    for output in outputs:
+        output.close()
+
+
+def initWorker(imagefile, ptcl_radius, normalize='eman2'):
+    global workerStack, workerRadius, workerNormalize
+    workerStack = stackIO.openStack(imagefile)
+    workerRadius = ptcl_radius
+    workerNormalize = normalize
+
+
+def normalizeChunk(bounds):
+    # read and normalize particles [first, last)
+    first, last = bounds
+    chunk = workerStack.read(first, last)
+    if (workerNormalize == 'numpy'):
+        return goldAPI.normalizeCircleMean(chunk, workerRadius)
+    for i in range(len(chunk)):
+        img = EMNumPy.numpy2em(chunk[i])
+        img.process_inplace('normalize.mask.circlemean', {'norm':1, 'mask':0, 'radius':workerRadius, 'masksoft':3})
+        chunk[i] = EMNumPy.em2numpy(img)
+    return chunk
+
+
+def particleShifts(seed, shape, index, centerShift):
+    # (dx, dy) shifts in [-centerShift, centerShift] of the particles
+    dx = np.floor(counterUniform(seed, shape, index, 0) * (2*centerShift+1)).astype(int) - centerShift
+    dy = np.floor(counterUniform(seed, shape, index, 1) * (2*centerShift+1)).astype(int) - centerShift
+    return np.column_stack((dx, dy))
+
+
+def particleMarkerPixels(seed, shape, index, marker_pixel, offset):
+    # marker pixels in [marker_pixel - offset, marker_pixel + offset) of the particles
+    u = counterUniform(seed, shape, index, 2)
+    return (marker_pixel - offset + 2*offset*u).astype(np.float32)
+
+
+def counterUniform(seed, shape, index, stream):
+    # counter based random numbers in [0, 1): the SplitMix64 hash of (seed, shape, particle index, stream).
+    # unlike the sequential random/np.random generators, the number of a particle does not depend on how
+    # many numbers were drawn before it
+    with np.errstate(over='ignore'):
+        key = splitmix64(np.array([seed & 0xffffffffffffffff], dtype=np.uint64))
+        key = splitmix64(key ^ np.uint64(zlib.crc32(shape) & 0xffffffff))
+        x = splitmix64(key ^ np.asarray(index, dtype=np.uint64))
+        x = splitmix64(x ^ np.uint64(stream))
+    return (x >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+
+def splitmix64(x):
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class MarkerROI(object):
+    # a marker stored as the patch inside its bounding box and the offset of the patch in the box, so that
+    # translating and adding it only touches the pixels of its region of interest
+    def __init__(self, marker, maxShift):
+        self.shape = marker.shape
+        self.maxShift = maxShift
+        ys, xs = np.nonzero(marker)
+        if len(ys):
+            self.y0, self.x0 = ys.min(), xs.min()
+            self.patch = np.array(marker[self.y0:ys.max()+1, self.x0:xs.max()+1], dtype=np.float32)
+        else:
+            self.y0, self.x0 = 0, 0
+            self.patch = np.zeros((0, 0), dtype=np.float32)
+        h, w = self.patch.shape
+        ny, nx = self.shape
+        # the shifted region of interest must stay inside the box, otherwise the zero filled full box translation is used
+        self.dense = None
+        if (self.y0 < maxShift or self.x0 < maxShift or self.y0+h+maxShift > ny or self.x0+w+maxShift > nx):
+            self.dense = shiftedMarkers(marker, maxShift)
+    
+    def roiIndex(self, shifts):
+        # index of the translated regions of interest in a (n, ny, nx) chunk
+        h, w = self.patch.shape
+        rows = (self.y0 + shifts[:, 1])[:, np.newaxis] + np.arange(h)
+        cols = (self.x0 + shifts[:, 0])[:, np.newaxis] + np.arange(w)
+        return (np.arange(len(shifts))[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :])
+    
+    def write(self, output, first, chunk, shifts, pixels):
+        # write the chunk with the marker, scaled by the marker pixels, added at the (dx, dy) shifts.
+        # the chunk is restored afterwards
+        pixels = pixels[:, np.newaxis, np.newaxis]
+        if self.dense is not None:
+            output.write(first, chunk + pixels * translateMarkers(self.dense, shifts))
+            return
+        index = self.roiIndex(shifts)
+        saved = chunk[index]
+        chunk[index] = saved + pixels * self.patch
+        output.write(first, chunk)
+        chunk[index] = saved
+
+
+class MarkerRaster(object):
+    # randomly rotated, scaled and placed copies of a shape, rasterized for a whole chunk at a time from the edge
+    # tables of its goldAPI.ShapeTemplate instead of one skimage drawing per particle: --markers markers per particle,
+    # each rotated by an angle in [-rotate, rotate] degrees, scaled by a factor in [1-size_jitter, 1+size_jitter] and
+    # shifted by (dx, dy) in [-centerShift, centerShift]. the first marker uses the shifts of particleShifts(), all
+    # other numbers come from counterUniform() streams 3 and up, so they also only depend on (seed, shape, particle index)
+    def __init__(self, shape, sizes, boxsize, seed, options):
+        self.template = goldAPI.ShapeTemplate(shape, sizes)
+        self.shape = shape
+        self.boxsize = boxsize
+        self.seed = seed
+        self.markers = options.markers
+        self.rotate = options.rotate
+        self.size_jitter = options.size_jitter
+        self.maxShift = options.centerShift
+        # half width of the largest scaled copy in any orientation
+        self.half = int(math.ceil(self.template.radius * (1 + self.size_jitter))) + 1
+    
+    def uniform(self, index, marker, stream):
+        return counterUniform(self.seed, self.shape, index, 3 + 4*marker + stream)
+    
+    def goldMasks(self, index, shifts):
+        # (n, w, w) bool masks of the union of the markers of the particles in the window of the box that any marker
+        # can reach, and the first row and column of the window in the box. the window is centered on the box
+        # center and cut off at the box edges
+        n = len(index)
+        reach = self.maxShift + self.half
+        window = np.zeros((n, 2*reach+1, 2*reach+1), dtype=bool)
+        for marker in range(self.markers):
+            if (marker > 0):
+                dx = np.floor(self.uniform(index, marker, 2) * (2*self.maxShift+1)).astype(int) - self.maxShift
+                dy = np.floor(self.uniform(index, marker, 3) * (2*self.maxShift+1)).astype(int) - self.maxShift
+                shifts = np.column_stack((dx, dy))
+            angles = np.radians(self.rotate * (2*self.uniform(index, marker, 0) - 1))
+            scales = 1 + self.size_jitter * (2*self.uniform(index, marker, 1) - 1)
+            window |= self.template.rasterize(2*reach+1, angles, scales, shifts)
+        c = self.boxsize//2
+        lo, hi = max(c - reach, 0), min(c + reach + 1, self.boxsize)
+        return window[:, lo-(c-reach):hi-(c-reach), lo-(c-reach):hi-(c-reach)], lo
+    
+    def write(self, output, first, chunk, shifts, pixels):
+        # write the chunk with the markers, scaled by the marker pixels, added. the chunk is restored afterwards
+        gold, lo = self.goldMasks(np.arange(first, first+len(chunk)), shifts)
+        hi = lo + gold.shape[1]
+        roi = chunk[:, lo:hi, lo:hi]
+        saved = roi.copy()
+        roi += pixels[:, np.newaxis, np.newaxis] * gold
+        output.write(first, chunk)
+        roi[...] = saved
+
+
+def shiftedMarkers(marker, maxShift):
+    # all copies of the marker translated by integer shifts in [-maxShift, maxShift], zero filled like 
+    # xform.translate.int, as a (2*maxShift+1, 2*maxShift+1, ny, nx) strided view of the zero padded marker
+    ny, nx = marker.shape
+    padded = np.zeros((ny+2*maxShift, nx+2*maxShift), dtype=np.float32)
+    padded[maxShift:maxShift+ny, maxShift:maxShift+nx] = marker
+    s0, s1 = padded.strides
+    return np.lib.stride_tricks.as_strided(padded, shape=(2*maxShift+1, 2*maxShift+1, ny, nx), strides=(s0, s1, s0, s1))
+
+
+def translateMarkers(shifted, shifts):
+    # (n, ny, nx) stack of the marker translated by the (dx, dy) shifts, gathered from the shiftedMarkers() view
+    maxShift = (shifted.shape[0]-1)/2
+    return shifted[maxShift-shifts[:, 1], maxShift-shifts[:, 0]]
+
+
+# the size options of each shape, in the order of the arguments of its mask function
+shapeOptions = goldAPI.shapeOptions
+
+
+def shapeMask(boxsize, shape, sizes):
+    # the gold mask of a shape with the values of its size options
+    functions = {'triangle':triangleMask, 'rectangle':rectMask, 'square':squareMask, 'diamond':diamondMask,
+        'octagon':octMask, 'star':starMask, 'ellipse':ellipseMask, 'circle':circleMask}
+    maskImg = EMData(boxsize, boxsize)
+    maskImg.to_zero()
+    return functions[shape](maskImg, *sizes)
+
+
+def shapeImage(function, maskImg, *sizes):
+    # the EMData image of a goldAPI shape function for the box of maskImg
+    try:
+        shapeArray = function(maskImg.get_xsize(), *sizes)
+    except ValueError, e:
+        print "ERROR: %s" % (e)
         sys.exit()
-    #n=3
-    for i in range(n):
-        img.read_image(imagefile, i)
-        img.process_inplace('normalize.mask.circlemean', {'norm':1, 'mask':0, 'radius':ptcl_radius, 'masksoft':3})
-	
-	#########################
-	a, b = random.randint(start, end), random.randint(start, end)
-	#print a, b
-	goldMaskTrans = goldMask.process('xform.translate.int', {'trans':(a, b)})
-        
-        #imgArray = EMNumPy.em2numpy(img)
-        #meanVal = np.mean(imgArray)
-        #m is the pixel value of simulated gold
-        #m = math.fabs(meanVal) * marker_pixel
-        #print meanVal, m
-	
-	img.add(goldMaskTrans)
-        #img.add(goldMask)
-        #goldMask.write_image("gold_mask.hdf")
-        img.write_image(outfile, i)
+    return EMNumPy.numpy2em(shapeArray)
         
 
 def circleMask(maskImg, circle_radius):
@@ -330,290 +536,35 @@ def circleMask(maskImg, circle_radius):
     circleImg.process_inplace("mask.sharp", {'outer_radius':circle_radius})
     
     return circleImg
-    
-    
+
+
 def ellipseMask(maskImg, ellipse_yradius, ellipse_xradius):
-    boxsize = maskImg.get_xsize()
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    if (boxsize <= ellipse_yradius * 2 or boxsize <= ellipse_xradius * 2):
-        print "ERROR: ellipse_xradius or ellipse_yradius is larger than the boxsize of particles."
-        sys.exit()
-    
-    #from skimage.draw import ellipse
-    #Generate coordinates of pixels within ellipse.
-    ####################################
-    '''
-    ellipse_xradius=random.randint(ellipse_xradius-10,ellipse_xradius+10)
-    print ellipse_xradius
-    ellipse_yradius=random.randint(ellipse_yradius-10,ellipse_yradius+10)
-    print ellipse_yradius
-    '''
-    size = max([ellipse_xradius, ellipse_yradius]) * 2 + 4
-    cx = size/2
-    cy = size/2
-    ellipseArray = np.zeros((size, size), dtype=np.uint8)
-    rr, cc = ellipse(cy, cx, ellipse_yradius, ellipse_xradius)
-    ellipseArray[rr, cc] = 1
-    
-    m, n = ellipseArray.shape
-    assert m==n
-    
-    if (m%2 == 0):
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2
-    else:
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2+1
-        
-    ellipseArrayPad = np.pad(ellipseArray, (pad_before, pad_after), mode='constant')
-    ellipseImg = EMNumPy.numpy2em(ellipseArrayPad)
-    return ellipseImg
+    return shapeImage(goldAPI.ellipseArray, maskImg, ellipse_yradius, ellipse_xradius)
 
 
 def starMask(maskImg, star_size):
-    boxsize = maskImg.get_xsize()
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    if (boxsize <= star_size):
-        print "ERROR: star size is larger than the boxsize of particles."
-        sys.exit()
-        
-    #from skimage.morphology import star
-    #Generates a star shaped structuring element that has 8 vertices and is an overlap of square of size 2*a + 1 with its 45 degree rotated version.
-    #The slanted sides are 45 or 135 degrees to the horizontal axis.
-    starArray = star(star_size, dtype=np.uint8)
-    m, n = starArray.shape
-    assert m==n
-    
-    if (m%2 == 0):
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2
-    else:
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2+1
-    
-    starArrayPad = np.pad(starArray, (pad_before, pad_after), mode='constant')
-    starImg = EMNumPy.numpy2em(starArrayPad)
-    return starImg
-    
-    
-        
+    return shapeImage(goldAPI.starArray, maskImg, star_size)
+
+
 def octMask(maskImg, octagon_m, octagon_n):
-    boxsize = maskImg.get_xsize()
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    if (boxsize <= octagon_n * 2 or boxsize <= octagon_m):
-        print "ERROR: (2 * the slanted sides) or (the horizontal and vertical sides) is larger than the boxsize of particles."
-        sys.exit()
-    
-    #from skimage.morphology import octagon
-    #Generates an octagon shaped structuring element with a given size of horizontal and vertical sides and a given height or width of slanted sides.
-    #The slanted sides are 45 or 135 degrees to the horizontal axis and hence the widths and heights are equal.
-    octArray = octagon(octagon_m, octagon_n, dtype=np.uint8)
-    m, n = octArray.shape
-    assert m==n
-    
-    if (m%2 == 0):
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2
-    else:
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2+1
-    
-    octArrayPad = np.pad(octArray, (pad_before, pad_after), mode='constant')
-    octImg = EMNumPy.numpy2em(octArrayPad)
-    return octImg
+    return shapeImage(goldAPI.octArray, maskImg, octagon_m, octagon_n)
 
 
 def diamondMask(maskImg, diamond_radius):
-    boxsize = maskImg.get_xsize()
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    if (boxsize <= (diamond_radius * 2 + 1)):
-        print "ERROR: the width of the square cannot be larger than the boxsize of particles."
-        sys.exit()
-        
-    #from skimage.morphology import diamond
-    #Generates a flat, diamond-shaped structuring element of a given radius.
-    #A pixel is part of the neighborhood (i.e. labeled 1) if the city block/manhattan distance between it and the center of the neighborhood is no greater than radius.
-    diamArray = diamond(diamond_radius, dtype=np.uint8)
-    m, n = diamArray.shape
-    assert m==n
-    
-    if (m%2 == 0):
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2
-    else:
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2+1
-        
-    diamArrayPad = np.pad(diamArray, (pad_before, pad_after), mode='constant')
-    diamImg = EMNumPy.numpy2em(diamArrayPad)
-    return diamImg
+    return shapeImage(goldAPI.diamondArray, maskImg, diamond_radius)
+
 
-'''
-def squareMask(maskImg, half_square_width):
-    boxsize = maskImg.get_xsize()
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    square_width = half_square_width * 2
-    if (boxsize <= square_width):
-        print "ERROR: the width of the square cannot be larger than the boxsize of particles."
-        sys.exit()
-        
-    #from skimage.morphology import square
-    #Generates a flat, square-shaped structuring element.
-    #Every pixel along the perimeter has a chessboard distance no greater than radius (radius=floor(width/2)) pixels.
-    squareArray = square(square_width, dtype=np.uint8)
-    
-    pad_width = (boxsize - square_width)/2
-    
-    squareArrayPad = np.pad(squareArray, pad_width, mode='constant')
-    squareImg = EMNumPy.numpy2em(squareArrayPad)
-    return squareImg
-'''
 def squareMask(maskImg, square_width): #both odd and even square_with are allowed
-    boxsize = maskImg.get_xsize()
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    if (boxsize <= square_width):
-        print "ERROR: the width of the square cannot be larger than the boxsize of particles."
-        sys.exit()
-        
-    #from skimage.morphology import square
-    #Generates a flat, square-shaped structuring element.
-    #Every pixel along the perimeter has a chessboard distance no greater than radius (radius=floor(width/2)) pixels.
-    squareArray = square(square_width, dtype=np.uint8)
-    m, n = squareArray.shape
-    assert m==n
-    
-    if (m%2 == 0):
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2
-    else:
-        pad_before = (boxsize - m)/2
-        pad_after = (boxsize - m)/2+1
-    #pad_width = (boxsize - square_width)/2
-    #print "m, n, pad_before, pad_after", m, n, pad_before, pad_after
-    #squareArrayPad = np.pad(squareArray, pad_width, mode='constant')
-    squareArrayPad = np.pad(squareArray, (pad_before, pad_after), mode='constant')
-    
-    squareImg = EMNumPy.numpy2em(squareArrayPad)
-    return squareImg
+    return shapeImage(goldAPI.squareArray, maskImg, square_width)
+
 
-'''       
-def rectMask(maskImg, width, height):
-    boxsize = maskImg.get_xsize()
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    if (boxsize <= width or boxsize <= height):
-        print "ERROR: the width or height of the rectangle cannot be larger than the boxsize of particles."
-        sys.exit()
-        
-    #from skimage.morphology import rectangle
-    #Generates a flat, rectangular-shaped structuring element of a given width and height.
-    #Every pixel in the rectangle belongs to the neighboorhood.
-    rectArray = rectangle(height, width, dtype=np.uint8)
-    #m, n = rectArray.shape
-    
-    pad_x = (boxsize - height)/2
-    pad_y = (boxsize - width)/2
-    rectArrayPad = np.pad(rectArray, ((pad_x, pad_x), (pad_y, pad_y)), mode='constant')
-    #m, n = rectArrayPad.shape
-    #print m, n
-    
-    #convert numpy to em image
-    rectImg = EMNumPy.numpy2em(rectArrayPad)
-    return rectImg
-'''   
-    
 def rectMask(maskImg, width, height):
-    boxsize = maskImg.get_xsize()
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    if (boxsize <= width or boxsize <= height):
-        print "ERROR: the width or height of the rectangle cannot be larger than the boxsize of particles."
-        sys.exit()
-        
-    #from skimage.morphology import rectangle
-    #Generates a flat, rectangular-shaped structuring element of a given width and height.
-    #Every pixel in the rectangle belongs to the neighboorhood.
-    rectArray = rectangle(height, width, dtype=np.uint8)
-    m, n = rectArray.shape
-    
-    if (m%2 == 0):
-        padRow_before = (boxsize - m)/2
-        padRow_after = (boxsize - m)/2
-    else:
-        padRow_before = (boxsize - m)/2
-        padRow_after = (boxsize - m)/2+1
-	
-	
-    if (n%2 == 0):
-        padCol_before = (boxsize - n)/2
-        padCol_after = (boxsize - n)/2
-    else:
-        padCol_before = (boxsize - n)/2
-        padCol_after = (boxsize - n)/2+1
-    
-    #pad_x = (boxsize - height)/2
-    #pad_y = (boxsize - width)/2
-    #rectArrayPad = np.pad(rectArray, ((pad_x, pad_x), (pad_y, pad_y)), mode='constant')
-    rectArrayPad = np.pad(rectArray, ((padRow_before, padRow_after), (padCol_before, padCol_after)), mode='constant')
-    #m, n = rectArrayPad.shape
-    #print m, n
-    
-    #convert numpy to em image
-    rectImg = EMNumPy.numpy2em(rectArrayPad)
-    return rectImg    
+    return shapeImage(goldAPI.rectArray, maskImg, width, height)
 
 
-    
-
 def triangleMask(maskImg, side):
-    boxsize = maskImg.get_xsize()
-    #print boxsize
-    
-    #convert em image to numpy
-    maskArray = EMNumPy.em2numpy(maskImg)
-    
-    if (boxsize <= side + 2):
-        print "ERROR: the side of the triangle cannot be larger than the boxsize of particles."
-        sys.exit()
-    
-    #Generate a flat, triangle-shaped structure element 
-    arraySize = boxsize
-    triArray = np.zeros((arraySize, arraySize), dtype=np.uint8)
-    '''
-    x0 = side/2
-    x1 = side
-    x2 = 3 * side/2
-    '''
-    x0 = boxsize/2 - side/2
-    x1 = boxsize/2
-    x2 = boxsize/2 + side/2
-    
-    y0 = boxsize/2 - side * (math.sqrt(3))/6
-    y1 = boxsize/2 + side * (math.sqrt(3))/3
-    y2 = y0
-    
-    x = np.array([x0, x1, x2, x0])
-    y = np.array([y0, y1, y2, y0])
-    #Generate coordinates of pixels within polygon. Here the polygon is triangle
-    rr, cc = polygon(y, x)
-    triArray[rr, cc] = 1
-    
-    #pad above triArray to the same size (boxsize) of maskArray(maskImg)
-    pad_width = (boxsize - arraySize)/2
-    triArrayPad = np.pad(triArray, pad_width, mode='constant') # Pads with a constant value. Default is 0.
-    
-    #convert numpy to em image
-    triImg = EMNumPy.numpy2em(triArrayPad)
-    return triImg
-        
-        
-        
-        
+    return shapeImage(goldAPI.triangleArray, maskImg, side)
+
+
 if __name__ == "__main__":
     main()
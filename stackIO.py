@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+# chunked particle stack I/O for maskGold.py
+# MRC/MRCS stacks are read through a memory map and written in contiguous blocks through one open file,
+# all other formats (hdf, spi, img, ...) go through EMAN2
+
+import os, struct, hashlib, errno
+
+import numpy
+
+mrcExtensions = [".mrc", ".mrcs"]
+
+# MRC mode -> numpy data type
+mrcModes = {0:numpy.int8, 1:numpy.int16, 2:numpy.float32, 6:numpy.uint16, 12:numpy.float16}
+
+def isMrc(filename):
+	return os.path.splitext(filename)[1].lower() in mrcExtensions
+
+def openStack(filename):
+	if isMrc(filename): return MrcStack(filename)
+	return EmanStack(filename)
+
+def createStack(filename, shape, append=False):
+	# shape = (ny, nx) of the images. append=True keeps the images already in the file
+	if isMrc(filename): return MrcStackWriter(filename, shape, append)
+	return EmanStackWriter(filename, shape)
+
+def imageCount(filename):
+	return len(openStack(filename))
+
+class MrcStack(object):
+	def __init__(self, filename):
+		self.filename = filename
+		header = open(filename, "rb").read(1024)
+		byteorder = "<"
+		nx, ny, nz, mode = struct.unpack(byteorder+"4i", header[:16])
+		if not (0<nx<2**16 and 0<ny<2**16):
+			byteorder = ">"
+			nx, ny, nz, mode = struct.unpack(byteorder+"4i", header[:16])
+		if mode not in mrcModes:
+			raise ValueError("MRC mode %d of %s is not supported" % (mode, filename))
+		nsymbt = struct.unpack(byteorder+"i", header[92:96])[0]
+		dtype = numpy.dtype(mrcModes[mode]).newbyteorder(byteorder)
+		self.shape = (ny, nx)
+		if nz>0:
+			self.data = numpy.memmap(filename, dtype=dtype, mode="r", offset=1024+nsymbt, shape=(nz, ny, nx))
+		else:
+			self.data = numpy.empty((0, ny, nx), dtype=dtype)
+
+	def __len__(self):
+		return self.data.shape[0]
+
+	def read(self, start, stop):
+		# one contiguous float32 copy of images [start, stop)
+		return numpy.array(self.data[start:stop], dtype=numpy.float32)
+
+class EmanStack(object):
+	def __init__(self, filename):
+		import EMAN2
+		self.EMAN2 = EMAN2
+		self.filename = filename
+		self.n = EMAN2.EMUtil.get_image_count(filename)
+		self.shape = None
+		if self.n:
+			d = EMAN2.EMData()
+			d.read_image(filename, 0, True)
+			self.shape = (d["ny"], d["nx"])
+
+	def __len__(self):
+		return self.n
+
+	def read(self, start, stop):
+		images = self.EMAN2.EMData.read_images(self.filename, range(start, stop))
+		chunk = numpy.empty((len(images),)+self.shape, dtype=numpy.float32)
+		for j, d in enumerate(images):
+			chunk[j] = self.EMAN2.EMNumPy.em2numpy(d)
+		return chunk
+
+class MrcStackWriter(object):
+	def __init__(self, filename, shape, append=False):
+		self.filename = filename
+		self.shape = tuple(shape)
+		self.n = 0
+		self.dmin, self.dmax, self.dsum, self.dsum2 = numpy.inf, -numpy.inf, 0.0, 0.0
+		if append and os.path.exists(filename):
+			self.fp = open(filename, "r+b")
+			nx, ny, nz = struct.unpack("<3i", self.fp.read(12))
+			if (ny, nx)!=self.shape:
+				raise ValueError("cannot append %d x %d images to %s with %d x %d images" % (self.shape[1], self.shape[0], filename, nx, ny))
+			self.fp.seek(76)
+			dmin, dmax, mean = struct.unpack("<3f", self.fp.read(12))
+			self.fp.seek(216)
+			rms = struct.unpack("<f", self.fp.read(4))[0]
+			self.n = nz
+			if nz:
+				npixel = nx*ny*nz
+				self.dmin, self.dmax, self.dsum, self.dsum2 = dmin, dmax, mean*npixel, (rms*rms+mean*mean)*npixel
+		else:
+			self.fp = open(filename, "w+b")
+			self.writeHeader()
+
+	def write(self, start, chunk):
+		chunk = numpy.ascontiguousarray(chunk, dtype=numpy.float32)
+		imageBytes = self.shape[0]*self.shape[1]*4
+		self.fp.seek(1024+start*imageBytes)
+		chunk.tofile(self.fp)
+		self.n = max(self.n, start+len(chunk))
+		if chunk.size:
+			self.dmin = min(self.dmin, float(chunk.min()))
+			self.dmax = max(self.dmax, float(chunk.max()))
+			self.dsum += float(chunk.sum(dtype=numpy.float64))
+			self.dsum2 += float(numpy.square(chunk, dtype=numpy.float64).sum())
+
+	def writeHeader(self):
+		ny, nx = self.shape
+		nz = self.n
+		npixel = max(nx*ny*nz, 1)
+		mean = self.dsum/npixel
+		rms = numpy.sqrt(max(self.dsum2/npixel-mean*mean, 0))
+		dmin, dmax = (self.dmin, self.dmax) if nz else (0.0, 0.0)
+		header = struct.pack("<10i", nx, ny, nz, 2, 0, 0, 0, nx, ny, max(nz, 1))
+		header += struct.pack("<6f", nx, ny, max(nz, 1), 90, 90, 90)
+		header += struct.pack("<3i", 1, 2, 3)
+		header += struct.pack("<3f", dmin, dmax, mean)
+		header += struct.pack("<2i", 0, 0)
+		header += "\0"*(196-len(header))
+		header += struct.pack("<3f", 0, 0, 0)
+		header += "MAP " + "\x44\x44\0\0" + struct.pack("<f", rms) + struct.pack("<i", 0)
+		header += "\0"*(1024-len(header))
+		self.fp.seek(0)
+		self.fp.write(header)
+
+	def flush(self):
+		# header and images on disk, e.g. before recording a checkpoint
+		self.writeHeader()
+		self.fp.flush()
+		os.fsync(self.fp.fileno())
+
+	def close(self):
+		self.writeHeader()
+		self.fp.close()
+
+class EmanStackWriter(object):
+	# EMAN2 keeps the output file open between write_image() calls. EMData.write_images() only writes a list from
+	# index 0, so the images of a chunk at an offset are written one at a time. mrcs is the default output format of
+	# maskGold.py and sweepGold.py for block writes
+	def __init__(self, filename, shape):
+		import EMAN2
+		self.EMAN2 = EMAN2
+		self.filename = filename
+		self.shape = tuple(shape)
+
+	def write(self, start, chunk):
+		for j in range(len(chunk)):
+			self.EMAN2.EMNumPy.numpy2em(chunk[j]).write_image(self.filename, start+j)
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+def fileHash(filename, blocksize=16*1024*1024):
+	# sha1 of the file content
+	sha1 = hashlib.sha1()
+	with open(filename, "rb") as fp:
+		for block in iter(lambda: fp.read(blocksize), ""):
+			sha1.update(block)
+	return sha1.hexdigest()
+
+class MaskStack(object):
+	# bit-packed binary masks of a particle stack with one fixed size record per particle for random access
+	# layout: 32 byte header (magic, version, n, ny, nx, key length), key, n flags (1 if the record is set), n records
+	magic = "GOLDMASK"
+	version = 1
+
+	def __init__(self, filename, n=None, shape=None, key="", mode="r"):
+		# mode "r": read an existing file. mode "r+": update an existing file. mode "a": update an existing file
+		# if n, shape and key match, otherwise create a new file. several processes may open the same file in mode
+		# "a" at once (--shard jobs sharing a --cache): the first file created is used by all of them and a file
+		# that matches is never replaced, only one that still does not match after the exclusive creation
+		self.filename = filename
+		if mode=="a" and not self.matches(filename, n, shape, key):
+			self.create(filename, n, shape, key, exclusive=True)
+			if not self.matches(filename, n, shape, key): self.create(filename, n, shape, key)
+		with open(filename, "rb") as fp:
+			header = fp.read(32)
+			if header[:8]!=self.magic:
+				raise ValueError("%s is not a mask stack file" % (filename))
+			version, n, ny, nx, keyLength = struct.unpack("<5i", header[8:28])
+			self.key = fp.read(keyLength)
+		self.n = n
+		self.shape = (ny, nx)
+		self.recordBytes = (ny*nx+7)//8
+		offset = 32+keyLength
+		memmapMode = "r" if mode=="r" else "r+"
+		if n>0:
+			self.flags = numpy.memmap(filename, dtype=numpy.uint8, mode=memmapMode, offset=offset, shape=(n,))
+			self.records = numpy.memmap(filename, dtype=numpy.uint8, mode=memmapMode, offset=offset+n, shape=(n, self.recordBytes))
+		else:
+			self.flags = numpy.zeros(0, dtype=numpy.uint8)
+			self.records = numpy.zeros((0, self.recordBytes), dtype=numpy.uint8)
+
+	@classmethod
+	def matches(cls, filename, n, shape, key):
+		if not os.path.exists(filename): return False
+		try:
+			stack = cls(filename)
+		except (ValueError, IOError, struct.error):
+			return False
+		return stack.n==n and stack.shape==tuple(shape) and stack.key==key
+
+	@classmethod
+	def create(cls, filename, n, shape, key, exclusive=False):
+		# the empty file is written under a unique temporary name and moved in place, so that other processes see
+		# either no file or a complete header. with exclusive, an existing file is kept (os.link does not replace)
+		ny, nx = shape
+		tmpFile = "%s.%s.tmp" % (filename, os.urandom(8).encode("hex"))
+		fd = os.open(tmpFile, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0666)
+		try:
+			with os.fdopen(fd, "wb") as fp:
+				fp.write(cls.magic + struct.pack("<5i", cls.version, n, ny, nx, len(key)) + "\0"*4)
+				fp.write(key)
+				fp.truncate(32+len(key)+n*(1+(ny*nx+7)//8))
+			if not exclusive:
+				os.rename(tmpFile, filename)
+				return
+			try:
+				os.link(tmpFile, filename)
+			except OSError, e:
+				if e.errno!=errno.EEXIST: raise
+		finally:
+			if os.path.exists(tmpFile): os.remove(tmpFile)
+
+	def __len__(self):
+		return self.n
+
+	def count(self):
+		# number of records that are set
+		return int(numpy.count_nonzero(self.flags))
+
+	def get(self, i):
+		# the (ny, nx) uint8 mask of particle i or None if not set
+		if not self.flags[i]: return None
+		return self.unpack(self.records[i:i+1])[0]
+
+	def read(self, start, stop):
+		# (n, ny, nx) uint8 masks of particles [start, stop) and their flags
+		return self.unpack(self.records[start:stop]), numpy.array(self.flags[start:stop])
+
+	def put(self, start, masks):
+		self.putPacked(start, self.pack(masks))
+
+	def putPacked(self, start, records):
+		self.records[start:start+len(records)] = records
+		self.flags[start:start+len(records)] = 1
+
+	@staticmethod
+	def pack(masks):
+		masks = numpy.asarray(masks)
+		return numpy.packbits(masks.reshape(len(masks), -1)>0, axis=1)
+
+	def unpack(self, records):
+		ny, nx = self.shape
+		return numpy.unpackbits(numpy.asarray(records), axis=1)[:, :ny*nx].reshape(-1, ny, nx)
+
+	def flush(self):
+		if isinstance(self.records, numpy.memmap):
+			self.records.flush()
+			self.flags.flush()
+
+	def close(self):
+		self.flush()
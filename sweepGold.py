@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+# parameter sweeps of simGold.py: simulated gold datasets for all combinations of a grid of marker and shape size
+# options. the input particles are read and normalized once into shared memory, the combinations are then simulated
+# by a pool of processes and listed with their parameters and output files in a manifest
+
+import os, sys, argparse, itertools, multiprocessing, json, time, random
+
+import numpy
+
+import simGold
+import stackIO
+from EMAN2 import EMNumPy
+
+# the options that can be swept and their types. the shape size options are only combined with their own shape
+sweepOptions = {"marker_pixel":float, "marker_pixel_offset":float, "centerShift":int, "triangle_side":int, "rect_width":int,
+	"rect_height":int, "square_width":int, "diamond_radius":int, "octagon_m":int, "octagon_n":int, "star_size":int,
+	"ellipse_yradius":int, "ellipse_xradius":int, "circle_radius":float}
+
+# the values of the marker options that are not in the grid, the simGold.py defaults
+markerDefaults = {"marker_pixel":1.0, "marker_pixel_offset":0.0, "centerShift":0}
+
+def main(argv=None):
+	args = parse_command_line(argv)
+
+	stack = stackIO.openStack(args.imagefile)
+	n = len(stack)
+	if not n:
+		print "ERROR: no particles in %s" % (args.imagefile)
+		sys.exit(-1)
+	ny, nx = stack.shape
+	if nx!=ny:
+		print "ERROR: nx!=ny"
+		sys.exit(-1)
+	if args.seed is None:
+		args.seed = random.randint(0, 2**31-1)
+		print "random seed: %d" % (args.seed)
+	if not os.path.isdir(args.outdir): os.makedirs(args.outdir)
+
+	combinations = sweepCombinations(args.shape, args.grid)
+	imageBaseName = os.path.splitext(os.path.basename(args.imagefile))[0]
+	tasks = [(i, shape, parameters, os.path.join(args.outdir, "%s_sim%s_%04d.%s" % (imageBaseName, shape.capitalize(), i, args.outformat)))
+		for i, (shape, parameters) in enumerate(combinations)]
+	print "%s\t %d images \t%d x %d\t%d combinations" % (args.imagefile, n, nx, ny, len(tasks))
+
+	# the normalized particles are shared by all processes. the pool is started after the shared array is allocated
+	# so that the worker processes inherit it
+	startTime = time.time()
+	shared = multiprocessing.RawArray("f", n*ny*nx)
+	if args.processes>1:
+		pool = multiprocessing.Pool(args.processes, initWorker, (shared, (n, ny, nx), args))
+		imap, imapUnordered = pool.imap, pool.imap_unordered
+	else:
+		pool = None
+		initWorker(shared, (n, ny, nx), args)
+		imap = imapUnordered = itertools.imap
+
+	chunks = [(first, min(first+args.chunksize, n)) for first in range(0, n, args.chunksize)]
+	for _ in imap(normalizeChunk, chunks): pass
+	normalizeTime = time.time()-startTime
+	if args.verbose: print "normalized %d particles in %.1f s" % (n, normalizeTime)
+
+	entries = []
+	for entry in imapUnordered(simulateCombination, tasks):
+		entries.append(entry)
+		if args.verbose:
+			print "%d/%d\t%s\t%s\t%.1f s" % (len(entries), len(tasks), entry["output"],
+				" ".join("%s=%g" % (k, v) for k, v in sorted(entry["parameters"].items())), entry["seconds"])
+	if pool:
+		pool.close()
+		pool.join()
+	entries.sort(key=lambda entry: entry["index"])
+
+	manifest = {"imagefile":args.imagefile, "particles":n, "boxsize":nx, "ptcl_radius":args.ptcl_radius, "seed":args.seed,
+		"shape":args.shape, "grid":args.grid, "normalize_seconds":normalizeTime, "seconds":time.time()-startTime, "combinations":entries}
+	manifestFile = args.manifest or os.path.join(args.outdir, "%s.sweep.json" % (imageBaseName))
+	with open(manifestFile, "w") as fp:
+		json.dump(manifest, fp, indent=1, sort_keys=True)
+	print "%d datasets in %.1f s, manifest: %s" % (len(entries), time.time()-startTime, manifestFile)
+
+def sweepCombinations(shapes, grid):
+	# (shape, parameters) of all combinations of the grid values of the marker options and of the size options of each shape
+	combinations = []
+	for shape in shapes:
+		names = ["marker_pixel", "marker_pixel_offset", "centerShift"] + simGold.shapeOptions[shape]
+		values = [grid.get(name, [markerDefaults.get(name)]) for name in names]
+		for combination in itertools.product(*values):
+			combinations.append((shape, dict(zip(names, combination))))
+	return combinations
+
+def initWorker(shared, shape, args):
+	global particles, options
+	particles = numpy.frombuffer(shared, dtype=numpy.float32).reshape(shape)
+	options = args
+	simGold.initWorker(args.imagefile, args.ptcl_radius, args.normalize)
+
+def normalizeChunk(bounds):
+	first, last = bounds
+	particles[first:last] = simGold.normalizeChunk(bounds)
+
+def simulateCombination(task):
+	index, shape, parameters, outfile = task
+	startTime = time.time()
+	n, ny, nx = particles.shape
+	goldMask = simGold.shapeMask(nx, shape, [parameters[name] for name in simGold.shapeOptions[shape]])
+	marker = simGold.MarkerROI(EMNumPy.em2numpy(goldMask), parameters["centerShift"])
+	output = stackIO.createStack(outfile, (ny, nx))
+	for first in range(0, n, options.chunksize):
+		last = min(first+options.chunksize, n)
+		ptclIndex = numpy.arange(first, last)
+		# a private copy of the shared particles, MarkerROI.write() adds the marker in place
+		chunk = numpy.array(particles[first:last])
+		shifts = simGold.particleShifts(options.seed, shape, ptclIndex, parameters["centerShift"])
+		pixels = simGold.particleMarkerPixels(options.seed, shape, ptclIndex, parameters["marker_pixel"], parameters["marker_pixel_offset"])
+		marker.write(output, first, chunk, shifts, pixels)
+	output.close()
+	return {"index":index, "shape":shape, "parameters":parameters, "output":outfile, "seconds":time.time()-startTime}
+
+def parseGrid(grid):
+	# ["name=v1,v2,...", ...] -> {name:[v1, v2, ...]}
+	values = {}
+	for item in grid:
+		name, sep, valueList = item.partition("=")
+		name = name.strip().lstrip("-")
+		if not sep or name not in sweepOptions:
+			raise ValueError("%s is not name=v1,v2,... with name one of %s" % (item, ",".join(sorted(sweepOptions))))
+		values[name] = [sweepOptions[name](v) for v in valueList.split(",") if v.strip()]
+		if not values[name]:
+			raise ValueError("no values for %s" % (name))
+	return values
+
+def parse_command_line(argv=None):
+	description = "simulate the gold datasets of simGold.py for all combinations of a grid of marker and shape size options"
+
+	parser = argparse.ArgumentParser(description=description)
+
+	parser.add_argument("imagefile", help="the file containing boxed particles, the simulated gold markers will be applied to these particles")
+
+	parser.add_argument("--shape", metavar="<s1,s2,...>", type=lambda s: s.split(","), help="the shapes of simulated gold markers (%s)" % (",".join(sorted(simGold.shapeOptions))), required=True)
+
+	parser.add_argument("--grid", metavar="<name=v1,v2,...>", action="append", help="values of a swept option (%s). can be repeated, all combinations of the values are simulated. the size options of each shape are required" % (",".join(sorted(sweepOptions))), default=[])
+
+	parser.add_argument("--ptcl_radius", metavar="<n>", type=float, help="radius of real particles, used in normalize.mask.circlemean", required=True)
+
+	parser.add_argument("--normalize", metavar="<numpy|eman2>", choices=["numpy", "eman2"], help="normalization of the particles, see simGold.py. default to eman2", default="eman2")
+
+	parser.add_argument("--seed", metavar="<n>", type=int, help="seed of the per particle shifts and marker pixels, see simGold.py. a random seed is used and printed if not set", default=None)
+
+	parser.add_argument("--outdir", metavar="<dir>", help="directory of the simulated stacks. default to the current directory", default=".")
+
+	parser.add_argument("--outformat", metavar="<hdf|mrcs>", choices=["hdf", "mrcs"], help="file format of the simulated stacks. mrcs files are written in blocks through one open file, hdf files one image at a time through EMAN2. default to mrcs", default="mrcs")
+
+	parser.add_argument("--manifest", metavar="<filename>", help="the json file listing the output file and parameters of each combination. default to <outdir>/<imagefile base name>.sweep.json", default=None)
+
+	parser.add_argument("--processes", metavar="<n>", type=int, help="number of worker processes. default to 1", default=1)
+
+	parser.add_argument("--chunksize", metavar="<n>", type=int, help="number of particles normalized and written at a time. default to 256", default=256)
+
+	parser.add_argument("--verbose", metavar="<n>", type=int, help="verbose level. default to 1", default=1)
+
+	args=parser.parse_args(argv)
+
+	for shape in args.shape:
+		if shape not in simGold.shapeOptions:
+			parser.error("unknown shape %s. choose from %s" % (shape, ",".join(sorted(simGold.shapeOptions))))
+	try:
+		args.grid = parseGrid(args.grid)
+	except ValueError, e:
+		parser.error(str(e))
+	for shape in args.shape:
+		missing = [name for name in simGold.shapeOptions[shape] if name not in args.grid]
+		if missing:
+			parser.error("%s requires --grid values of %s" % (shape, ",".join(missing)))
+
+	return args
+
+if __name__== "__main__":
+	main()